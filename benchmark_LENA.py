@@ -0,0 +1,101 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from master_LENA_v2 import parse_its_file, process_directory, process_one_file
+from synthetic_its import write_synthetic_its
+
+#_______________________________________________________________________________
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def timed_stage(stage, its_path, output_dir, jobs):
+    # runs one stage in the current (fresh) process and returns (seconds, peak RSS in MB)
+    start = time.perf_counter()
+    if stage == "parse_its_file":
+        parse_its_file(its_path)
+    elif stage == "process_one_file":
+        child_id = os.path.basename(its_path)[:7]
+        os.makedirs(output_dir, exist_ok=True)
+        process_one_file(its_path, child_id, output_dir)
+    else:
+        process_directory(its_path, output_dir, jobs, force=True)
+    elapsed = time.perf_counter() - start
+    # worker processes of process_directory are counted separately
+    return elapsed, max(peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+def run_isolated(stage, its_path, output_dir, jobs=1):
+    # every measurement runs in a freshly spawned process so peak RSS is not shared between runs
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(timed_stage, stage, its_path, output_dir, jobs).result()
+
+def benchmark(stage, its_path, output_dir, segments, repeat, jobs=1):
+    runs = [run_isolated(stage, its_path, output_dir, jobs) for _ in range(repeat)]
+    best = min(elapsed for elapsed, _ in runs)
+    return {
+        "stage": stage,
+        "input": os.path.basename(its_path.rstrip("/")),
+        "segments": segments,
+        "seconds": round(best, 4),
+        "segments_per_second": round(segments / best, 1) if best > 0 else None,
+        "peak_rss_mb": round(max(rss for _, rss in runs), 1),
+    }
+
+def print_results(results):
+    print(f"{'stage':<18} {'input':<24} {'segments':>10} {'seconds':>9} {'segments/s':>12} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['stage']:<18} {r['input']:<24} {r['segments']:>10} {r['seconds']:>9.3f} {r['segments_per_second'] or 0:>12.0f} {r['peak_rss_mb']:>12.1f}")
+
+#_______________________________________________________________________________
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing and writing of synthetic .its files.")
+    parser.add_argument("--hours", type=float, nargs="+", default=[1.0, 4.0, 16.0], help="Recording lengths to benchmark, in hours")
+    parser.add_argument("--cohort", type=int, default=8, help="Number of files in the process_directory benchmark")
+    parser.add_argument("--cohort-hours", type=float, default=2.0, help="Recording length of each cohort file, in hours")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Worker processes for the process_directory benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the fastest is reported")
+    parser.add_argument("--workdir", help="Keep generated inputs and outputs in this directory instead of a temporary one")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        inputs = os.path.join(workdir, "inputs")
+        cohort = os.path.join(workdir, "cohort")
+        outputs = os.path.join(workdir, "outputs")
+        for path in (inputs, cohort, outputs):
+            os.makedirs(path, exist_ok=True)
+
+        results = []
+
+        # Single files of increasing length
+        for i, hours in enumerate(args.hours):
+            its_path = os.path.join(inputs, f"B{i:06d}_20200101.its")
+            segments = write_synthetic_its(its_path, hours, seed=i)
+            for stage in ("parse_its_file", "process_one_file"):
+                results.append(benchmark(stage, its_path, os.path.join(outputs, stage), segments, args.repeat))
+            results[-1]["hours"] = results[-2]["hours"] = hours
+
+        # A small cohort for process_directory
+        segments = 0
+        for i in range(args.cohort):
+            segments += write_synthetic_its(os.path.join(cohort, f"C{i:06d}_20200101.its"), args.cohort_hours, seed=1000 + i)
+        result = benchmark("process_directory", cohort, os.path.join(outputs, "process_directory"), segments, args.repeat, args.jobs)
+        result.update({"hours": args.cohort_hours * args.cohort, "files": args.cohort, "jobs": args.jobs})
+        results.append(result)
+
+        print_results(results)
+        if args.json:
+            with open(args.json, "w") as fh:
+                json.dump(results, fh, indent=1)
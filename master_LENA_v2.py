@@ -1,8 +1,31 @@
 import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import lzma
 import os
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import tarfile
+import threading
+import time
+import zipfile
 import pandas as pd
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 from lxml import etree
 import numpy as np
+try:
+    import resource # not available on Windows, peak memory is then left out of the metrics
+except ImportError:
+    resource = None
 
 #_______________________________________________________________________________
 
@@ -10,298 +33,1618 @@ def extract_time(text):
     # removes PT and S from timestamp string and converts it to float
     return float(text[2:-1])
 
-def parse_its_file(its_file):
-    chi_utt = []
-    fan_utt = []
-    man_utt = []
-    oln_utt = []
-    olf_utt = []
-    ct_cnt = []
+def extract_duration(text):
+    # ISO durations such as 'P1.23S' or 'PT1.23S' in seconds
+    return float(text.lstrip('PT')[:-1])
+
+#_______________________________________________________________________________
+
+# Column layouts of the extracted tables as (column, typecode, ITS attribute, converter, default).
+# Rows are appended to growable typed arrays ('i' int32, 'f' float32, 'd' float64), 'U' columns are
+# lists of strings stored as categoricals, and its_file_name (typecode None) holds the same value on
+# every row so it is not stored. Attributes without a default are required, columns without an
+# attribute are NA (overlapping speech has no word or utterance counts).
+CORE_COLUMNS = [("seg_id", "i", None, None, None), ("onset", "d", None, None, None),
+                ("offset", "d", None, None, None), ("duration", "d", None, None, None)]
+DB_COLUMNS = [("avg_dB", "f", "average_dB", float, None), ("peak_dB", "f", "peak_dB", float, None)]
+ITS_FILE_NAME_COLUMN = ("its_file_name", None, None, None, None)
+
+def adult_columns(prefix):
+    return [("wordCount", "f", f"{prefix}WordCnt", float, None),
+            ("nonSpeechDur", "f", f"{prefix}NonSpeechLen", extract_duration, None),
+            ("uttCnt", "i", f"{prefix}UttCnt", int, None),
+            ("uttLength", "f", f"{prefix}UttLen", extract_duration, None)]
+
+OVERLAP_COLUMNS = [("wordCount", "f", None, None, None), ("nonSpeechDur", "f", None, None, None),
+                   ("uttCnt", "f", None, None, None), ("uttLength", "f", None, None, None)]
+
+TABLE_COLUMNS = {
+    "CHN": DB_COLUMNS + [("childUttCnt", "i", "childUttCnt", int, None),
+                         ("childUttLen", "f", "childUttLen", extract_duration, None),
+                         ("childCryVfxLen", "f", "childCryVfxLen", extract_duration, None),
+                         ITS_FILE_NAME_COLUMN],
+    "FAN": DB_COLUMNS + adult_columns("femaleAdult") + [ITS_FILE_NAME_COLUMN],
+    "MAN": DB_COLUMNS + adult_columns("maleAdult") + [ITS_FILE_NAME_COLUMN],
+    "OLN": DB_COLUMNS + OVERLAP_COLUMNS + [ITS_FILE_NAME_COLUMN],
+    "OLF": DB_COLUMNS + OVERLAP_COLUMNS + [ITS_FILE_NAME_COLUMN],
+    "CTC": DB_COLUMNS + [("convo_count", "i", "turnTaking", int, None), ITS_FILE_NAME_COLUMN,
+                         ("ct_type", "U", "type", str, None)]
+                      + [(name, "i", name, int, "0") for name in ("femaleAdultInitiation", "maleAdultInitiation", "childResponse",
+                                                                  "childInitiation", "femaleAdultResponse", "maleAdultResponse")]
+                      + [(name, "f", name, float, "0") for name in ("adultWordCnt", "femaleAdultWordCnt", "maleAdultWordCnt")]
+                      + [(name, "i", name, int, "0") for name in ("femaleAdultUttCnt", "maleAdultUttCnt")]
+                      + [(name, "f", name, extract_duration, "P0.00S") for name in ("femaleAdultUttLen", "maleAdultUttLen",
+                                                                                    "femaleAdultNonSpeechLen", "maleAdultNonSpeechLen")]
+                      + [("childUttCnt", "i", "childUttCnt", int, "0")]
+                      + [(name, "f", name, extract_duration, "P0.00S") for name in ("childUttLen", "childCryVfxLen", "TVF", "FAN")],
+}
+SPEAKERS = ["CHN", "FAN", "MAN", "OLN", "OLF"]
+# optional columns that can be selected with --fields; core columns and its_file_name are always kept
+FIELDS = sorted({column[0] for columns in TABLE_COLUMNS.values() for column in columns if column[1] is not None})
+# keys of the tables in the dictionary returned by parse_its_file
+TABLE_KEYS = {
+    "CHN": "child_utterances",
+    "FAN": "female_utterances",
+    "MAN": "male_utterances",
+    "OLN": "overlapping_near_utterances",
+    "OLF": "overlapping_far_utterances",
+    "CTC": "conversation_turns",
+}
+NUMPY_TYPES = {"i": np.int32, "f": np.float32, "d": np.float64}
+NA = float('nan')
+
+def table_schema(table, fields=None):
+    # core columns plus the requested optional columns, in the order they are written
+    return CORE_COLUMNS + [column for column in TABLE_COLUMNS[table]
+                           if fields is None or column[1] is None or column[0] in fields]
+
+def new_columns(schema):
+    return {column[0]: ([] if column[1] == "U" else array(column[1])) for column in schema if column[1] is not None}
+
+def append_row(columns, row):
+    # row values follow the schema order, without the its_file_name column
+    for column, value in zip(columns.values(), row):
+        column.append(value)
+
+def extract_row(attrib, extractors):
+    # values of the optional columns of one element, converted from their ITS attributes
+    row = []
+    for attribute, convert, default in extractors:
+        if attribute is None:
+            row.append(NA)
+        elif default is None:
+            row.append(convert(attrib[attribute]))
+        else:
+            row.append(convert(attrib.get(attribute, default)))
+    return row
+
+def columns_to_frame(columns, schema, its_file_name):
+    # numeric columns are zero-copy views over the typed arrays
+    data = {}
+    for name, typecode, *_ in schema:
+        if typecode is None:
+            data[name] = pd.Categorical.from_codes(np.zeros(len(columns["seg_id"]), dtype=np.int8), categories=[its_file_name])
+        elif typecode == "U":
+            data[name] = pd.Categorical(columns[name])
+        else:
+            data[name] = np.frombuffer(columns[name], dtype=NUMPY_TYPES[typecode])
+    return pd.DataFrame(data, copy=False)
+
+def constant_array(value, length):
+    # a column holding the same string on every row, stored once as a one-entry dictionary
+    import pyarrow as pa
+    return pa.DictionaryArray.from_arrays(pa.array(np.zeros(length, dtype=np.int8)), pa.array([value]))
+
+def columns_to_table(columns, schema, its_file_name, child_id, bin_seconds):
+    # Arrow counterpart of columns_to_frame for the arrow engine: numeric columns wrap the typed arrays
+    # without copying, its_file_name and child_id are dictionary-encoded constants, and 'seconds' is
+    # computed with Arrow compute kernels; no pandas objects are created
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    length = len(columns["seg_id"])
+    arrays = {}
+    for name, typecode, *_ in schema:
+        if typecode is None:
+            arrays[name] = constant_array(its_file_name, length)
+        elif typecode == "U":
+            arrays[name] = pa.array(columns[name], pa.string()).dictionary_encode()
+        else:
+            arrays[name] = pa.array(np.frombuffer(columns[name], dtype=NUMPY_TYPES[typecode]))
+    arrays["seconds"] = pc.add(pc.multiply(pc.floor(pc.divide(arrays["offset"], float(bin_seconds))), float(bin_seconds)), float(bin_seconds))
+    arrays["child_id"] = constant_array(child_id, length)
+    return pa.table(arrays)
+
+def as_frame(table):
+    # pandas view of a table from either engine, for CSV output and the stores
+    return table if isinstance(table, pd.DataFrame) else table.to_pandas()
+
+ENGINES = ["pandas", "arrow"]
+
+ARCHIVE_SEP = "!/" # separates an archive from the path of a member, e.g. site1.zip!/AB12345_20200101.its
+DECOMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+def strip_compression(name):
+    root, ext = os.path.splitext(name)
+    return root if ext in DECOMPRESSORS else name
+
+def is_its_name(name):
+    return strip_compression(name).endswith(".its")
+
+@lru_cache(maxsize=None)
+def archive_members(archive, mtime_ns):
+    # stored size of every .its member of a zip or tar archive, listed once per version of the archive
+    if archive.endswith(".zip"):
+        with zipfile.ZipFile(archive) as zf:
+            return {info.filename: info.compress_size for info in zf.infolist() if not info.is_dir() and is_its_name(info.filename)}
+    with tarfile.open(archive) as tf:
+        return {info.name: info.size for info in tf.getmembers() if info.isfile() and is_its_name(info.name)}
+
+@lru_cache(maxsize=4)
+def open_tar(archive, mtime_ns):
+    # a tar archive kept open in this process with its member index, so each member is reached by
+    # seeking forward from the previous one instead of reopening the archive and decompressing it from
+    # the start. Members are read one at a time by the parsing thread
+    tf = tarfile.open(archive)
+    return tf, {info.name: info for info in tf.getmembers()}
+
+@lru_cache(maxsize=4)
+def tar_hashes(archive, mtime_ns, chunk_size=1 << 20):
+    # SHA-256 of every .its member of a tar archive, computed in one sequential pass over the archive
+    hashes = {}
+    with tarfile.open(archive, "r|*") as tf:
+        for info in tf:
+            if info.isfile() and is_its_name(info.name):
+                sha = hashlib.sha256()
+                fh = tf.extractfile(info)
+                for chunk in iter(lambda: fh.read(chunk_size), b''):
+                    sha.update(chunk)
+                hashes[info.name] = sha.hexdigest()
+    return hashes
+
+def input_stat(its_file):
+    # (stored size, modification time in ns) of an input file; archive members get the time of the archive
+    archive, sep, member = its_file.partition(ARCHIVE_SEP)
+    st = os.stat(archive)
+    if not sep:
+        return st.st_size, st.st_mtime_ns
+    return archive_members(archive, st.st_mtime_ns)[member], st.st_mtime_ns
+
+def input_exists(its_file):
+    try:
+        input_stat(its_file)
+        return True
+    except (OSError, KeyError, zipfile.BadZipFile, tarfile.TarError):
+        return False
+
+@contextmanager
+def open_input(its_file):
+    # binary stream of an input as stored: a file on disk or a member of a zip or tar archive
+    archive, sep, member = its_file.partition(ARCHIVE_SEP)
+    if not sep:
+        with open(its_file, 'rb') as fh:
+            yield fh
+    elif archive.endswith(".zip"):
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as fh:
+            yield fh
+    else:
+        tf, members = open_tar(archive, os.stat(archive).st_mtime_ns)
+        with tf.extractfile(members[member]) as fh:
+            yield fh
+
+@contextmanager
+def its_source(its_file):
+    # what iterparse reads: the path of a plain .its file, or a stream that decompresses a
+    # .gz/.bz2/.xz file or an archive member on the fly, so no temporary files are written
+    decompress = DECOMPRESSORS.get(os.path.splitext(its_file)[1])
+    if ARCHIVE_SEP not in its_file and decompress is None:
+        yield its_file
+        return
+    with open_input(its_file) as fh:
+        if decompress is None:
+            yield fh
+        else:
+            with decompress(fh) as stream:
+                yield stream
+
+def iter_its_elements(its_file, tags=("ChildInfo", "Recording", "Segment", "Conversation", "Pause")):
+    # streams the requested elements in document order with iterparse; each element is
+    # cleared once the caller is done with it so memory stays flat for long recordings
+    with its_source(its_file) as source:
+        for _, elem in etree.iterparse(source, events=("end",), tag=tags):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def parse_its_file(its_file, speakers=SPEAKERS, fields=None, conversations=True, metrics=None):
+    # extracts only the requested speakers, optional fields and conversation turns;
+    # other segments are skipped before any of their attributes are converted.
+    # When a metrics dict is given, extraction time is timed per table (this adds some overhead).
+    tables = list(speakers) + (["CTC"] if conversations else [])
+    schemas = {table: table_schema(table, fields) for table in tables}
+    columns = {table: new_columns(schemas[table]) for table in tables}
+    extractors = {table: [(attribute, convert, default) for _, typecode, attribute, convert, default in schemas[table][len(CORE_COLUMNS):]
+                          if typecode is not None]
+                  for table in tables}
+    segment_columns = {spkr: columns[spkr] for spkr in speakers}
+    seg_ids = dict.fromkeys(tables, 0)
+    extract_seconds = dict.fromkeys(tables, 0.0)
+    clock = time.perf_counter if metrics is not None else None
+    start = time.perf_counter()
     child_info = []
     all_rec_info = []
 
-    xmldoc = etree.parse(its_file)
-
-    # Extract Child Information
-    for seg in xmldoc.iter('ChildInfo'):
-        DOB = seg.attrib['dob']
-        gender = seg.attrib['gender']
-        age = seg.attrib['chronologicalAge'][1:3]
-        child_info.append([DOB, gender, age])
-
-    # Extract Recording Information
-    for s in xmldoc.iter('Recording'):
-        startClockTime = s.attrib['startClockTime']
-        endClockTime = s.attrib['endClockTime']
-        startTimeSecs = s.attrib['startTime'][2:]
-        endTimeSecs = s.attrib['endTime'][2:]
-        all_rec_info.append([startClockTime, endClockTime, startTimeSecs, endTimeSecs])
-    
-     # Combine all information
-    all_info = child_info[0] + all_rec_info[0]
-
-    # Extract Utterances
-    chn_seg_id = 0
-    fan_seg_id = 0
-    man_seg_id = 0
-    oln_seg_id = 0
-    olf_seg_id = 0
-    ct_seg_id = 0
-    for seg in xmldoc.iter('Segment'):
-        seg_spkr = seg.attrib.get('spkr')
-
-        onset = extract_time(seg.attrib['startTime'])
-        offset = extract_time(seg.attrib['endTime'])
-        duration = offset - onset
-        avg_dB = seg.attrib['average_dB']
-        peak_dB = seg.attrib['peak_dB']  
-        its_file_name = its_file[its_file.rfind('/') + 1:its_file.rfind('.')]    
-
-        if seg_spkr == "CHN":
-            chn_seg_id += 1
-            childUttCnt = seg.attrib['childUttCnt']
-            childUttLen = seg.attrib['childUttLen']
-            childCryVfxLen = seg.attrib['childCryVfxLen']
-            chi_utt.append([chn_seg_id, onset, offset, duration, avg_dB, peak_dB, childUttCnt, childUttLen, childCryVfxLen, its_file_name])
-
-        elif seg_spkr == "FAN":
-            fan_seg_id += 1
-            uttCnt = seg.attrib['femaleAdultUttCnt']
-            uttLength = seg.attrib['femaleAdultUttLen']
-            wordCount = seg.attrib['femaleAdultWordCnt']
-            nonSpeechDur = seg.attrib['femaleAdultNonSpeechLen']
-            fan_utt.append([fan_seg_id, onset, offset, duration, avg_dB, peak_dB, wordCount, nonSpeechDur, uttCnt, uttLength, its_file_name])
-
-        elif seg_spkr == "MAN":
-            man_seg_id += 1
-            uttCnt = seg.attrib['maleAdultUttCnt']
-            uttLength = seg.attrib['maleAdultUttLen']
-            wordCount = seg.attrib['maleAdultWordCnt']
-            nonSpeechDur = seg.attrib['maleAdultNonSpeechLen']
-            man_utt.append([man_seg_id, onset, offset, duration, avg_dB, peak_dB, wordCount, nonSpeechDur, uttCnt, uttLength, its_file_name])            
-        
-        elif seg_spkr == "OLN":
-            oln_seg_id += 1
-            uttCnt = 'NA'
-            uttLength = 'NA'            
-            wordCount = 'NA'
-            nonSpeechDur = 'NA'
-            oln_utt.append([oln_seg_id, onset, offset, duration, avg_dB, peak_dB, wordCount, nonSpeechDur, uttCnt, uttLength, its_file_name])
-
-        elif seg_spkr == "OLF":
-            olf_seg_id += 1
-            uttCnt = 'NA'
-            uttLength = 'NA'            
-            wordCount = 'NA'
-            nonSpeechDur = 'NA'
-            olf_utt.append([olf_seg_id, onset, offset, duration, avg_dB, peak_dB, wordCount, nonSpeechDur, uttCnt, uttLength, its_file_name])
+    its_file_name = its_name(its_file)
 
-        else:
-            continue
+    # Conversation and Pause are always streamed, even when they are not extracted, so the
+    # containers are cleared as they end instead of building up under Recording
+    tags = ["ChildInfo", "Recording", "Conversation", "Pause"]
+    if speakers:
+        tags.append("Segment")
+
+    # Single pass over the document; segments and conversations keep their document order
+    for seg in iter_its_elements(its_file, tuple(tags)):
+        tag = seg.tag
+
+        # Extract Child Information
+        if tag == 'ChildInfo':
+            DOB = seg.attrib['dob']
+            gender = seg.attrib['gender']
+            age = seg.attrib['chronologicalAge'][1:3]
+            child_info.append([DOB, gender, age])
+
+        # Extract Recording Information
+        elif tag == 'Recording':
+            startClockTime = seg.attrib['startClockTime']
+            endClockTime = seg.attrib['endClockTime']
+            startTimeSecs = seg.attrib['startTime'][2:]
+            endTimeSecs = seg.attrib['endTime'][2:]
+            all_rec_info.append([startClockTime, endClockTime, startTimeSecs, endTimeSecs])
+
+        # Extract Utterances
+        elif tag == 'Segment':
+            seg_spkr = seg.attrib.get('spkr')
+            if seg_spkr not in segment_columns:
+                continue
 
-    # Extract Conversation Turns
-    for seg in xmldoc.iter('Conversation'):
-        if seg.attrib.get('turnTaking') != '0':
-            ct_seg_id += 1
+            if clock:
+                t0 = clock()
+            seg_ids[seg_spkr] += 1
             onset = extract_time(seg.attrib['startTime'])
             offset = extract_time(seg.attrib['endTime'])
-            duration = offset - onset
-            avg_dB = seg.attrib['average_dB']
-            peak_dB = seg.attrib['peak_dB']
-            cnt = seg.attrib['turnTaking']
-            ct_type = seg.attrib['type']
-            femaleAdultInitiation = seg.attrib.get('femaleAdultInitiation', '0')
-            maleAdultInitiation = seg.attrib.get('maleAdultInitiation', '0')
-            childResponse = seg.attrib.get('childResponse', '0')
-            childInitiation = seg.attrib.get('childInitiation', '0')
-            femaleAdultResponse = seg.attrib.get('femaleAdultResponse', '0')
-            maleAdultResponse = seg.attrib.get('maleAdultResponse', '0')
-            adultWordCnt = seg.attrib.get('adultWordCnt', '0')
-            femaleAdultWordCnt = seg.attrib.get('femaleAdultWordCnt', '0')
-            maleAdultWordCnt = seg.attrib.get('maleAdultWordCnt', '0')
-            femaleAdultUttCnt = seg.attrib.get('femaleAdultUttCnt', '0')
-            maleAdultUttCnt = seg.attrib.get('maleAdultUttCnt', '0')
-            femaleAdultUttLen = seg.attrib.get('femaleAdultUttLen', 'P0.00S')
-            maleAdultUttLen = seg.attrib.get('maleAdultUttLen', 'P0.00S')
-            femaleAdultNonSpeechLen = seg.attrib.get('femaleAdultNonSpeechLen', 'P0.00S')
-            maleAdultNonSpeechLen = seg.attrib.get('maleAdultNonSpeechLen', 'P0.00S')
-            childUttCnt = seg.attrib.get('childUttCnt', '0')
-            childUttLen = seg.attrib.get('childUttLen', 'P0.00S')
-            childCryVfxLen = seg.attrib.get('childCryVfxLen', 'P0.00S')
-            TVF = seg.attrib.get('TVF', 'P0.00S')
-            FAN = seg.attrib.get('FAN', 'P0.00S')  
-            ct_cnt.append([
-                ct_seg_id, onset, offset, duration, avg_dB, peak_dB, cnt, its_file_name,
-                ct_type, femaleAdultInitiation, maleAdultInitiation, childResponse, childInitiation,
-                femaleAdultResponse, maleAdultResponse, adultWordCnt, femaleAdultWordCnt,
-                maleAdultWordCnt, femaleAdultUttCnt, maleAdultUttCnt, femaleAdultUttLen,
-                maleAdultUttLen, femaleAdultNonSpeechLen, maleAdultNonSpeechLen, childUttCnt,
-                childUttLen, childCryVfxLen, TVF, FAN
-            ])
+            append_row(segment_columns[seg_spkr], [seg_ids[seg_spkr], onset, offset, offset - onset] + extract_row(seg.attrib, extractors[seg_spkr]))
+            if clock:
+                extract_seconds[seg_spkr] += clock() - t0
 
-    return {
-        "child_utterances": chi_utt,
-        "female_utterances": fan_utt, 
-        "male_utterances": man_utt, 
-        "overlapping_near_utterances": oln_utt, 
-        "overlapping_far_utterances": olf_utt, 
-        "conversation_turns": ct_cnt,
-        "combined_info": all_info
-    }
+        # Extract Conversation Turns
+        elif tag == 'Conversation' and conversations:
+            if seg.attrib.get('turnTaking') != '0':
+                if clock:
+                    t0 = clock()
+                seg_ids["CTC"] += 1
+                onset = extract_time(seg.attrib['startTime'])
+                offset = extract_time(seg.attrib['endTime'])
+                append_row(columns["CTC"], [seg_ids["CTC"], onset, offset, offset - onset] + extract_row(seg.attrib, extractors["CTC"]))
+                if clock:
+                    extract_seconds["CTC"] += clock() - t0
+
+    if metrics is not None:
+        # parse time is the XML reading that is left once per-table extraction is taken out
+        metrics["seconds"]["parse"] = time.perf_counter() - start - sum(extract_seconds.values())
+        metrics["seconds"]["extract"] = extract_seconds
+        metrics["segments"] = dict(seg_ids)
+
+    parsed_data = {TABLE_KEYS[table]: columns[table] for table in tables}
+    parsed_data.update({
+        "schemas": schemas,
+        "child_info": child_info,
+        "recordings": all_rec_info,
+        "its_file_name": its_file_name
+    })
+    return parsed_data
 
 #_______________________________________________________________________________
 
-def list_to_csv(list_ts, output_file, output_dir): # to remember intermediaries
+def report_error(message, errors=None):
+    # print straight away, or collect the message when a worker reports back at the end of the run
+    if errors is None:
+        print(message)
+    else:
+        errors.append(message)
+
+def list_to_csv(list_ts, output_file, output_dir, errors=None): # to remember intermediaries
     try:
-        list_ts.to_csv(os.path.join(output_dir, output_file)) # write dataframe to file
+        list_ts.to_csv(os.path.join(output_dir, output_file), na_rep='NA') # write dataframe to file
     except Exception as e:
-        print(f"Error: An unexpected error occurred while writing {output_file} to csv: {e}")    
+        report_error(f"Error: An unexpected error occurred while writing {output_file} to csv: {e}", errors)    
 
-#_______________________________________________________________________________
+OUTPUT_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+DATASET_DIR = "lena_dataset"
+# per-bin summaries written with --aggregate, and the columns each one sums per bin
+BIN_COLUMNS = {
+    "CHN": ["childUttCnt"],
+    "FAN": ["wordCount", "uttCnt"],
+    "MAN": ["wordCount", "uttCnt"],
+    "OLN": [],
+    "OLF": [],
+    "CTC": ["convo_count"],
+}
+# columns of the its_info table: child information, the first Recording, the child ID and the input path
+INFO_COLUMNS = ["DOB", "gender", "age_mos", "startClockTime", "endClockTime", "startTimeSecs", "endTimeSecs", "child_id", "filename"]
+# its_info of the bolivia layout: child information, start of the first and end of the last Recording
+BOLIVIA_INFO_COLUMNS = ["DOB", "gender", "age_mos", "startClockTime", "endClockTime", "startTimeSecs", "endTimeSecs", "its_file_name"]
+# 'default': child ID from the first 7 characters of the file name, one output directory per child;
+# 'bolivia': the output of master_LENA_boliviaVoc_v2.py, see file_child_id and build_tables
+LAYOUTS = ["default", "bolivia"]
+# identifiers and clock times stay text even when they look numeric
+TEXT_COLUMNS = {"its_file_name", "child_id", "filename", "DOB", "gender", "ct_type", "startClockTime", "endClockTime"}
+
+def its_name(its_file):
+    # file name without directory, compression suffix and extension, as stored in the its_file_name column
+    name = strip_compression(its_file[its_file.rfind('/') + 1:])
+    return name[:name.rfind('.')]
+
+def file_child_id(filename, layout="default"):
+    # child ID of a file name without extension; the bolivia layout keeps the site, child and day parts
+    # (e.g. LB_01_123456, AB12345_20200101_2), so every recording gets its own output directory
+    if layout == "bolivia":
+        parts = filename.split('_')
+        return '_'.join(parts[-3:]) if len(parts[-1]) != 6 else '_'.join(parts[-2:])
+    return filename[:7]
+
+TABLE_LABELS = {
+    "CHN": "Child Utterances",
+    "FAN": "Female Utterances",
+    "MAN": "Male Utterances",
+    "OLN": "Overlapping Near Utterances",
+    "OLF": "Overlapping Far Utterances",
+    "CTC": "Conversation Turns",
+}
+
+def requested_tables(speakers=SPEAKERS, conversations=True):
+    # speaker and conversation tables in output order
+    return [table for table in TABLE_KEYS if table in speakers or (table == "CTC" and conversations)]
+
+def output_tables(aggregate=False, speakers=SPEAKERS, conversations=True):
+    tables = requested_tables(speakers, conversations)
+    if aggregate:
+        return tables + ["its_info"] + [f"{table}_bins" for table in tables]
+    return tables + ["its_info"]
 
-def process_one_file(its_file, child_id, output_dir):
+def output_file_name(child_id, table, output_format="csv"):
+    if table == "its_info" or table.endswith("_bins"):
+        return f"{child_id}_{table}{OUTPUT_FORMATS[output_format]}"
+    return f"{child_id}_{table}_timestamps{OUTPUT_FORMATS[output_format]}"
+
+def dataset_file_path(dataset_dir, table, child_id, its_file, output_format):
+    # one file per recording, partitioned by speaker table and child_id (hive style)
+    return os.path.join(dataset_dir, table, f"child_id={child_id}", f"{its_name(its_file)}{OUTPUT_FORMATS[output_format]}")
+
+def typed_columns(df):
+    # numeric strings become float64 and 'NA' placeholders become nulls, so every recording
+    # gets the same column types; ISO durations stay as text
+    df = df.reset_index(drop=True)
+    if df.empty:
+        return df
+    for col in df.columns:
+        if col in TEXT_COLUMNS or pd.api.types.is_numeric_dtype(df[col]) or pd.api.types.is_datetime64_any_dtype(df[col]):
+            continue
+        values = pd.to_numeric(df[col], errors='coerce')
+        if values.notna().sum() == (df[col] != 'NA').sum():
+            df[col] = values.astype('float64')
+    return df
+
+def typed_table(table):
+    # Arrow counterpart of typed_columns, for the text columns of its_info
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    for i, name in enumerate(table.column_names):
+        column = table.column(i)
+        if name in TEXT_COLUMNS or not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)) or table.num_rows == 0:
+            continue
+        try:
+            values = pc.cast(pc.if_else(pc.equal(column, "NA"), pa.scalar(None, column.type), column), pa.float64())
+        except pa.ArrowInvalid:
+            continue
+        table = table.set_column(i, name, values)
+    return table
+
+def write_columnar(df, path, output_format, errors=None):
     try:
-        parsed_data = parse_its_file(its_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(df, pd.DataFrame):
+            df = typed_columns(df)
+            if output_format == "parquet":
+                df.to_parquet(path, index=False, compression="zstd")
+            else:
+                df.to_feather(path, compression="zstd")
+        else:
+            # tables of the arrow engine are written without going through pandas
+            import pyarrow.feather as feather
+            import pyarrow.parquet as pq
+            if output_format == "parquet":
+                pq.write_table(typed_table(df), path, compression="zstd")
+            else:
+                feather.write_feather(typed_table(df), path, compression="zstd")
     except Exception as e:
-        print(f"Failed to parse ITS file {its_file}: {e}")     
+        report_error(f"Error: An unexpected error occurred while writing {os.path.basename(path)} to {output_format}: {e}", errors)
+
+#_______________________________________________________________________________
+
+def bin_durations(onset, offset, bin_seconds, n_bins):
+    # time covered by [onset, offset) in each bin; segments crossing a boundary are split between bins
+    first = (onset // bin_seconds).astype(np.int64)
+    last = np.maximum(np.ceil(offset / bin_seconds).astype(np.int64) - 1, first)
+    same = first == last
+    totals = np.zeros(n_bins)
+    totals += np.bincount(first[same], weights=(offset - onset)[same], minlength=n_bins)
+
+    cross = ~same
+    a, b, f, l = onset[cross], offset[cross], first[cross], last[cross]
+    totals += np.bincount(f, weights=(f + 1) * bin_seconds - a, minlength=n_bins)
+    totals += np.bincount(l, weights=b - l * bin_seconds, minlength=n_bins)
+
+    # whole bins in between, counted with a difference array
+    covered = np.bincount(f + 1, minlength=n_bins + 1) - np.bincount(l, minlength=n_bins + 1)
+    totals += np.cumsum(covered)[:n_bins] * bin_seconds
+    return totals
 
-    # Process Child Utterances
+def column_values(df, col):
+    # numpy values of a column of a DataFrame or an Arrow table; numeric strings are converted, others become NaN
+    if isinstance(df, pd.DataFrame):
+        return pd.to_numeric(df[col], errors='coerce').to_numpy()
+    return df.column(col).to_numpy()
+
+def aggregate_bins(df, bin_seconds, n_bins, sum_columns=(), arrow=False):
+    # counts and sums go to the bin of the segment offset, the same bin as the 'seconds' column;
+    # with arrow=True the summary is returned as a pyarrow Table
+    onset = np.asarray(column_values(df, 'onset'), dtype=np.float64)
+    offset = np.asarray(column_values(df, 'offset'), dtype=np.float64)
+    end_bins = (offset // bin_seconds).astype(np.int64)
+
+    summary = {
+        "seconds": (np.arange(n_bins) + 1) * bin_seconds,
+        "segment_count": np.bincount(end_bins, minlength=n_bins),
+        "duration": bin_durations(onset, offset, bin_seconds, n_bins),
+    }
+    for col in sum_columns:
+        values = np.nan_to_num(column_values(df, col))
+        # counts stay integers like segment_count, and float32 columns keep their precision so sums
+        # print as they read in the ITS file
+        if np.issubdtype(values.dtype, np.integer):
+            dtype = np.int64
+        else:
+            dtype = np.float32 if values.dtype == np.float32 else np.float64
+        summary[col] = np.bincount(end_bins, weights=values.astype(np.float64), minlength=n_bins).astype(dtype)
+    if arrow:
+        import pyarrow as pa
+        return pa.table(summary)
+    return pd.DataFrame(summary)
+
+def bin_count(dfs, bin_seconds):
+    # enough bins to hold the last offset of any table, so every speaker of a file shares one timeline
+    max_offset = max([column_values(df, 'offset').max() for df in dfs if len(df)], default=0)
+    return int(max_offset // bin_seconds) + 1
+
+#_______________________________________________________________________________
+
+def recording_timeline(recordings):
+    # interval index of the Recording blocks: start in recording-relative seconds, start clock time
+    # (UTC) and recording number (document order, like the num attribute), sorted by start
+    if not recordings:
+        return None
+    starts = np.array([float(start[:-1]) for _, _, start, _ in recordings], dtype=np.float64)
+    clocks = pd.to_datetime([clock for clock, _, _, _ in recordings], utc=True, format="ISO8601").tz_convert(None).to_numpy(dtype="datetime64[ns]")
+    order = np.argsort(starts, kind="stable")
+    return starts[order], clocks[order], (order + 1).astype(np.int32)
+
+def align_to_recordings(onset, offset, timeline):
+    # assigns every row to the Recording block that contains its onset with one vectorized searchsorted
+    # over the block starts, and turns onset/offset into clock times; returns (recording_id, onset_clock, offset_clock)
+    if timeline is None:
+        missing = np.full(len(onset), np.datetime64("NaT"), dtype="datetime64[ns]")
+        return np.zeros(len(onset), dtype=np.int32), missing, missing.copy()
+    starts, clocks, numbers = timeline
+    # an onset before the first block goes to the first block, with its clock time counted back from that block's start
+    block = np.clip(np.searchsorted(starts, onset, side="right") - 1, 0, len(starts) - 1)
+    base = clocks[block]
+    onset_clock = base + np.rint((onset - starts[block]) * 1e9).astype("timedelta64[ns]")
+    offset_clock = base + np.rint((offset - starts[block]) * 1e9).astype("timedelta64[ns]")
+    return numbers[block], onset_clock, offset_clock
+
+def add_clock_columns(df, timeline):
+    # recording_id, onset_clock and offset_clock (UTC) on a DataFrame or an Arrow table
+    recording_id, onset_clock, offset_clock = align_to_recordings(np.asarray(column_values(df, 'onset'), dtype=np.float64),
+                                                                  np.asarray(column_values(df, 'offset'), dtype=np.float64), timeline)
+    if isinstance(df, pd.DataFrame):
+        df['recording_id'] = recording_id
+        df['onset_clock'] = pd.to_datetime(onset_clock, utc=True)
+        df['offset_clock'] = pd.to_datetime(offset_clock, utc=True)
+        return df
+    import pyarrow as pa
+    clock_type = pa.timestamp("ns", tz="UTC")
+    df = df.append_column("recording_id", pa.array(recording_id))
+    df = df.append_column("onset_clock", pa.array(onset_clock.view(np.int64), clock_type, mask=np.isnat(onset_clock)))
+    return df.append_column("offset_clock", pa.array(offset_clock.view(np.int64), clock_type, mask=np.isnat(offset_clock)))
+
+def build_tables(its_file, child_id, errors=None, bin_seconds=60, aggregate=False, speakers=SPEAKERS, fields=None, conversations=True,
+                 metrics=None, engine="pandas", clock_times=True, strict=False, layout="default"):
+    # parses one .its file into a list of (table, DataFrame) in output order, without writing anything;
+    # with engine="arrow" the tables are pyarrow Tables built straight from the extracted columns.
+    # With strict=True the first error is raised instead of being reported. The bolivia layout leaves
+    # out the child_id columns and its its_info spans all Recording blocks
     try:
-        all_chn_timestamps = parsed_data["child_utterances"]
-        df_chn = pd.DataFrame(all_chn_timestamps, columns=["seg_id", "onset", "offset", "duration", "avg_dB", "peak_dB", "childUttCnt", "childUttLen", "childCryVfxLen", "its_file_name"])
-        df_chn['offset'] = pd.to_numeric(df_chn['offset']) 
-        df_chn['seconds'] = ((df_chn['offset'] // 60) * 60) + 60
-        df_chn['child_id'] = child_id
+        parsed_data = parse_its_file(its_file, speakers, fields, conversations, metrics)
     except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Child Utterances in file {its_file}: {e}")
+        if strict:
+            raise
+        report_error(f"Failed to parse ITS file {its_file}: {e}", errors)
+        return []
+
+    # Process Utterances and Conversation Turns of the requested speakers
+    tables = []
+    if clock_times:
+        try:
+            timeline = recording_timeline(parsed_data["recordings"])
+        except Exception as e:
+            if strict:
+                raise
+            report_error(f"Error: An unexpected error occurred while reading the Recording times in file {its_file}: {e}", errors)
+            clock_times = False
+    for table in requested_tables(speakers, conversations):
+        try:
+            t0 = time.perf_counter()
+            if engine == "arrow":
+                df = columns_to_table(parsed_data[TABLE_KEYS[table]], parsed_data["schemas"][table], parsed_data["its_file_name"], child_id, bin_seconds)
+                if layout == "bolivia":
+                    df = df.drop_columns(['child_id'])
+            else:
+                df = columns_to_frame(parsed_data[TABLE_KEYS[table]], parsed_data["schemas"][table], parsed_data["its_file_name"])
+                df['seconds'] = ((df['offset'] // bin_seconds) * bin_seconds) + bin_seconds
+                if layout != "bolivia":
+                    df['child_id'] = child_id
+            if clock_times:
+                df = add_clock_columns(df, timeline)
+            tables.append((table, df))
+            if metrics is not None:
+                metrics["seconds"]["dataframes"][table] = time.perf_counter() - t0
+        except Exception as e:
+            if strict:
+                raise
+            report_error(f"Error: An unexpected error occurred while processing {TABLE_LABELS[table]} in file {its_file}: {e}", errors)
 
-    # Process Female Utterances
+    # Process Child Information
     try:
-        all_fan_timestamps = parsed_data["female_utterances"]
-        df_fan = pd.DataFrame(all_fan_timestamps, columns=["seg_id", "onset", "offset", "duration", "avg_dB", "peak_dB", "wordCount", "nonSpeechDur", "uttCnt", "uttLength", "its_file_name"])
-        df_fan['offset'] = pd.to_numeric(df_fan['offset']) 
-        df_fan['seconds'] = ((df_fan['offset'] // 60) * 60) + 60
-        df_fan['child_id'] = child_id    
+        if layout == "bolivia":
+            # start of the first Recording element, end of the last one
+            startClockTime, _, startTimeSecs, _ = parsed_data["recordings"][0]
+            _, endClockTime, _, endTimeSecs = parsed_data["recordings"][-1]
+            all_info = parsed_data["child_info"][0] + [startClockTime, endClockTime, startTimeSecs, endTimeSecs, parsed_data["its_file_name"]]
+            info_columns = BOLIVIA_INFO_COLUMNS
+        else:
+            all_info = parsed_data["child_info"][0] + parsed_data["recordings"][0] + [child_id, its_file]
+            info_columns = INFO_COLUMNS
+        if engine == "arrow":
+            import pyarrow as pa
+            # large_string, the type pandas writes its text columns with
+            df_info = pa.table({col: pa.array([value], pa.large_string()) for col, value in zip(info_columns, all_info)})
+        else:
+            df_info = pd.DataFrame([all_info], columns=info_columns)
+        tables.append(("its_info", df_info))
     except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Female Utterances in file {its_file}: {e}")
+        if strict:
+            raise
+        report_error(f"Error: An unexpected error occurred while processing Child Information in file {its_file}: {e}", errors)
+
+    # Aggregate per time bin
+    if aggregate:
+        try:
+            n_bins = bin_count([df for table, df in tables if table in BIN_COLUMNS], bin_seconds)
+            for table, df in list(tables):
+                if table in BIN_COLUMNS:
+                    if engine == "arrow":
+                        df_bins = aggregate_bins(df, bin_seconds, n_bins, [col for col in BIN_COLUMNS[table] if col in df.column_names], arrow=True)
+                        if layout != "bolivia":
+                            df_bins = df_bins.append_column("child_id", constant_array(child_id, df_bins.num_rows))
+                    else:
+                        df_bins = aggregate_bins(df, bin_seconds, n_bins, [col for col in BIN_COLUMNS[table] if col in df.columns])
+                        if layout != "bolivia":
+                            df_bins['child_id'] = child_id
+                    tables.append((f"{table}_bins", df_bins))
+        except Exception as e:
+            if strict:
+                raise
+            report_error(f"Error: An unexpected error occurred while aggregating time bins in file {its_file}: {e}", errors)
+
+    return tables
+
+def table_path(table, its_file, child_id, output_dir, output_format="csv", dataset_dir=None):
+    if dataset_dir is not None:
+        return dataset_file_path(dataset_dir, table, child_id, its_file, output_format)
+    return os.path.join(output_dir, output_file_name(child_id, table, output_format))
+
+METRICS_LOCK = threading.Lock()
+
+def write_table(path, df, errors=None, output_format="csv", dataset_dir=None, metrics=None):
+    t0 = time.perf_counter()
+
+    # Write dataframes to CSV
+    if output_format == "csv":
+        list_to_csv(as_frame(df), os.path.basename(path), os.path.dirname(path), errors)
+
+    # Write dataframes to typed, compressed columnar files
+    elif dataset_dir is None:
+        write_columnar(df, path, output_format, errors)
+    else:
+        # child_id is carried by the partition directory
+        write_columnar(df.drop(columns=['child_id']) if isinstance(df, pd.DataFrame) else df.drop_columns(['child_id']), path, output_format, errors)
+
+    if metrics is not None:
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        # writer threads of one file update the same metrics dict
+        with METRICS_LOCK:
+            metrics["seconds"]["write"][os.path.basename(path)] = time.perf_counter() - t0
+            metrics["bytes_written"] += size
+
+def bounded_submitter(executor, queue_size):
+    # hands writes to a writer pool; at most queue_size tables wait for a writer, so parsing blocks
+    # instead of piling up DataFrames. A write to a path that is still pending waits for the earlier
+    # one, so later files overwrite earlier ones as in a serial run
+    slots = threading.BoundedSemaphore(queue_size)
+    pending = {}
+    # the done-callbacks run in writer threads, possibly after submit() has already stored the next write
+    # to the same path, so checking and deleting the entry must not interleave with submit()
+    lock = threading.Lock()
+
+    def release(path, future):
+        slots.release()
+        with lock:
+            if pending.get(path) is future:
+                del pending[path]
+
+    def submit(path, fn, *args):
+        with lock:
+            earlier = pending.get(path)
+        if earlier is not None:
+            earlier.result()
+        slots.acquire()
+        future = executor.submit(fn, path, *args)
+        with lock:
+            pending[path] = future
+        future.add_done_callback(lambda done: release(path, done))
+        return future
+    return submit
+
+def process_one_file(its_file, child_id, output_dir, errors=None, output_format="csv", dataset_dir=None, bin_seconds=60, aggregate=False,
+                     speakers=SPEAKERS, fields=None, conversations=True, metrics=None, submit=None, engine="pandas", clock_times=True,
+                     layout="default"):
+    # when a metrics dict is given it is filled with per-stage timings, sizes and the peak memory of the process so far;
+    # when submit is given (see bounded_submitter) the tables are written in the background
+    if metrics is not None:
+        file_start = time.perf_counter()
+        metrics.update({"file": its_file, "child_id": child_id, "bytes_read": input_stat(its_file)[0], "bytes_written": 0,
+                        "seconds": {"dataframes": {}, "write": {}}})
+
+    tables = build_tables(its_file, child_id, errors, bin_seconds, aggregate, speakers, fields, conversations, metrics, engine, clock_times,
+                          layout=layout)
+
+    for table, df in tables:
+        path = table_path(table, its_file, child_id, output_dir, output_format, dataset_dir)
+        if submit is None:
+            write_table(path, df, errors, output_format, dataset_dir, metrics)
+        else:
+            submit(path, write_table, df, errors, output_format, dataset_dir, metrics)
+
+    # with background writes the total only covers parsing and building the tables
+    if metrics is not None:
+        metrics["seconds"]["total"] = time.perf_counter() - file_start
+        metrics["process_peak_rss_mb"] = peak_rss_mb()
+
+#_______________________________________________________________________________
+
+def check_options(speakers=SPEAKERS, fields=None, bin_seconds=60):
+    # returns the speakers in table order and the sorted fields, raises ValueError for unknown names
+    # and for bins narrower than a second
+    if bin_seconds < 1:
+        raise ValueError(f"the bin width must be at least 1 second, got {bin_seconds}")
+    unknown = set(speakers) - set(SPEAKERS)
+    if unknown:
+        raise ValueError(f"unknown speaker(s) {', '.join(sorted(unknown))}, choose from {','.join(SPEAKERS)}")
+    unknown = set(fields or []) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"unknown field(s) {', '.join(sorted(unknown))}, choose from {','.join(FIELDS)}")
+    return [spkr for spkr in SPEAKERS if spkr in speakers], sorted(set(fields)) if fields else None
+
+def read_its_file(its_file, child_id=None, arrow=False, errors=None, bin_seconds=60, aggregate=False, speakers=SPEAKERS, fields=None,
+                  conversations=True, clock_times=True, layout="default"):
+    # library entry point: returns {table: DataFrame} for one .its file (CHN, FAN, ..., CTC, its_info and
+    # the *_bins tables with aggregate=True), or pyarrow Tables built by the arrow engine with arrow=True;
+    # nothing is written to disk. Errors are raised, unless an errors list is given to collect them in,
+    # in which case the tables that could be built are returned
+    speakers, fields = check_options(speakers, fields, bin_seconds)
+    if child_id is None:
+        child_id = file_child_id(its_name(its_file), layout)
+    tables = build_tables(its_file, child_id, errors, bin_seconds, aggregate, speakers, fields, conversations,
+                          engine="arrow" if arrow else "pandas", clock_times=clock_times, strict=errors is None, layout=layout)
+    if not arrow:
+        return dict(tables)
+    # same column types as the parquet/feather output
+    return {table: typed_table(df) for table, df in tables}
+
+def iter_its_directory(directory, arrow=False, errors=None, **options):
+    # yields (its_file, child_id, tables) one recording at a time so a cohort can be streamed through
+    # analysis code; files are selected with the same rules as process_directory. Like read_its_file,
+    # errors are raised unless an errors list is given, then files that fail are reported there and skipped
+    check_options(options.get("speakers", SPEAKERS), options.get("fields"), options.get("bin_seconds", 60))
+    for f, its_file, child_id in list_its_files(directory, layout=options.get("layout", "default")):
+        reported = len(errors) if errors is not None else 0
+        try:
+            tables = read_its_file(its_file, child_id, arrow, errors, **options)
+        except Exception as e:
+            if errors is None:
+                raise
+            report_error(f"Error: An unexpected error occurred while processing file '{f}': {str(e)}", errors)
+            continue
+        # with an errors list, read_its_file reports a file that cannot be parsed instead of raising
+        if errors is not None and (not tables or len(errors) > reported):
+            continue
+        yield its_file, child_id, tables
+
+def list_its_files(directory, warned=None, layout="default"):
+    # applies the child ID and duplicate-day rules, returns (file name, path, child_id) in sorted order;
+    # .gz/.bz2/.xz files and the .its members of zip/tar archives are listed like plain .its files.
+    # With a warned set, each skipped file or unreadable archive is only reported once. The bolivia
+    # layout has no duplicate-day rule, since every recording gets its own child ID
+    its_files = []
+    processed_files = set()
+    for entry in sorted(os.listdir(directory)):
+        names = [entry]
+        if entry.endswith(ARCHIVE_SUFFIXES):
+            try:
+                archive = os.path.join(directory, entry)
+                names = [entry + ARCHIVE_SEP + member for member in sorted(archive_members(archive, os.stat(archive).st_mtime_ns))]
+            except Exception as e:
+                if warned is None or entry not in warned:
+                    print(f"Error: An unexpected error occurred while reading archive {entry}: {e}")
+                if warned is not None:
+                    warned.add(entry)
+                continue
+
+        for f in names:
+            if is_its_name(f) and f not in processed_files:
+                # the rules apply to the base name of the .its file, without compression suffix
+                name = strip_compression(os.path.basename(f))
+                if layout != "bolivia" and name[-6] == '_':
+                    if warned is None or f not in warned:
+                        print(f"Warning: Multiple files might be present for the same day. Skipping file {f}")
+                    if warned is not None:
+                        warned.add(f)
+                    continue
+
+                filename, _ = os.path.splitext(name)
+                its_file = os.path.join(directory, f)
+                child_id = file_child_id(filename, layout)
+                its_files.append((f, its_file, child_id))
+                processed_files.add(f)
+    return its_files
+
+def process_file_group(group, output_base, partitioned=False, options=None, collect_metrics=False, submit=None):
+    # files sharing an output directory run in order so later ones overwrite earlier ones as in a serial run
+    results = []
+    for f, its_file, child_id in group:
+        errors = []
+        metrics = {} if collect_metrics else None
+        output_dir = os.path.join(output_base, f"{child_id}_output")
+        dataset_dir = os.path.join(output_base, DATASET_DIR) if partitioned else None
+        try:
+            if dataset_dir is None:
+                os.makedirs(output_dir, exist_ok=True)
+            process_one_file(its_file, child_id, output_dir, errors, dataset_dir=dataset_dir, metrics=metrics, submit=submit, **(options or {}))
+        except Exception as e:
+            errors.append(f"Error: An unexpected error occurred while processing file '{f}': {str(e)}")
+        results.append((f, errors, metrics))
+    return results
+
+def process_file_groups(groups, output_base, partitioned=False, options=None, collect_metrics=False, writers=1, write_queue=16):
+    # pipeline mode: this process parses the groups one after another while a pool of writer threads
+    # drains the finished tables, so writing one file overlaps with parsing the next
+    results = []
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        submit = bounded_submitter(executor, write_queue)
+        for group in groups:
+            results.extend(process_file_group(group, output_base, partitioned, options, collect_metrics, submit))
+    # leaving the with block waits for the last writes, so errors and metrics are complete here
+    return results
+
+def balanced_lanes(groups, lanes):
+    # splits groups into lanes of similar total input size, largest groups first; ties keep the
+    # input order, so the split is the same on every machine that sees the same files
+    buckets = [[] for _ in range(lanes)]
+    sizes = [0] * lanes
+    for group in sorted(groups, key=lambda group: -sum(input_stat(its_file)[0] for _, its_file, _ in group)):
+        lane = sizes.index(min(sizes))
+        buckets[lane].append(group)
+        sizes[lane] += sum(input_stat(its_file)[0] for _, its_file, _ in group)
+    return buckets
+
+def process_directory(directory, output_base, jobs=1, force=False, partitioned=False, profile=False, metrics_out=None, writers=0,
+                      write_queue=16, shard=None, its_files=None, **options):
+    # options are passed on to process_one_file (output_format, bin_seconds, aggregate, speakers, fields, conversations, layout, ...);
+    # with writers > 0 each process writes its tables from a bounded queue of writer threads (pipeline mode);
+    # with shard=(index, count) only that shard of the directory is processed, see merge_shards;
+    # its_files, as returned by list_its_files, restricts the run to those files (used by watch_directory)
+    run_start = time.perf_counter()
+    collect_metrics = profile or metrics_out is not None
+    if its_files is None:
+        its_files = list_its_files(directory, layout=options.get("layout", "default"))
+
+    # Group files by output directory; the files of a group always run together and in order
+    groups = {}
+    for f, its_file, child_id in its_files:
+        groups.setdefault(child_id, []).append((f, its_file, child_id))
+
+    # Keep only this node's shard; the files of a child always stay in the same shard
+    manifest_name = MANIFEST_FILE
+    if shard is not None:
+        index, count = shard
+        groups = {group[0][2]: group for group in balanced_lanes(list(groups.values()), count)[index]}
+        its_files = [entry for group in groups.values() for entry in group]
+        manifest_name = shard_manifest_name(index, count)
+        print(f"Shard {index}/{count}: {len(its_files)} file(s) of {len(groups)} child ID(s)")
+        # a marker left by an earlier run would wrongly mark this run as complete while it is still going
+        marker_path = os.path.join(output_base, shard_marker_name(index, count))
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        shard_files = [f for f, _, _ in its_files]
+
+    # Skip groups whose inputs and outputs match the manifest of the previous run
+    manifest = load_manifest(output_base, manifest_name)
+    if options.get("output_format") in STORE_FORMATS and not os.path.exists(store_path(output_base, options["output_format"])):
+        # the store was removed, so the recordings listed in the manifest have to be loaded again
+        manifest["files"] = {}
+    if not force:
+        stale_groups = {child_id: group for child_id, group in groups.items() if not group_is_current(group, output_base, manifest, partitioned, options)}
+        skipped = len(its_files) - sum(len(group) for group in stale_groups.values())
+        if skipped:
+            print(f"Skipping {skipped} unchanged file(s), use --force to rebuild them")
+        groups = stale_groups
+
+    results = []
+    if options.get("output_format") in STORE_FORMATS:
+        results = load_store(groups, output_base, jobs, options, collect_metrics)
+
+        # Report errors at the end, in file order
+        for f, errors, _ in sorted(results, key=lambda result: result[0]):
+            for message in errors:
+                print(message)
+    elif writers > 0:
+        if jobs <= 1:
+            results = process_file_groups(list(groups.values()), output_base, partitioned, options, collect_metrics, writers, write_queue)
+        else:
+            # every worker process keeps its own writer pool for a lane of groups
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(process_file_groups, lane, output_base, partitioned, options, collect_metrics, writers, write_queue)
+                           for lane in balanced_lanes(list(groups.values()), jobs) if lane]
+                for future in as_completed(futures):
+                    results.extend(future.result())
+
+        # Report errors at the end, in file order
+        for f, errors, _ in sorted(results, key=lambda result: result[0]):
+            for message in errors:
+                print(message)
+    elif jobs <= 1:
+        for group in groups.values():
+            group_results = process_file_group(group, output_base, partitioned, options, collect_metrics)
+            for f, errors, _ in group_results:
+                for message in errors:
+                    print(message)
+            results.extend(group_results)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(process_file_group, group, output_base, partitioned, options, collect_metrics) for group in groups.values()]
+            for future in as_completed(futures):
+                results.extend(future.result())
+
+        # Report errors at the end, in file order
+        for f, errors, _ in sorted(results, key=lambda result: result[0]):
+            for message in errors:
+                print(message)
+
+    update_manifest(manifest, groups, results, output_base, partitioned, options)
+    save_manifest(manifest, output_base, manifest_name)
+
+    if shard is not None:
+        write_shard_marker(output_base, index, count, shard_files, sorted(f for f, errors, _ in results if errors))
+
+    if collect_metrics:
+        file_metrics = [metrics for _, _, metrics in sorted(results, key=lambda result: result[0])]
+        report_metrics(file_metrics, time.perf_counter() - run_start, jobs, profile, metrics_out)
 
-    # Process Male Utterances
+def watch_directory(directory, output_base, poll_seconds=10, settle_seconds=30, **kwargs):
+    # keeps processing new and changed files until interrupted; kwargs are passed on to process_directory.
+    # A file is ready once its size and modification time have not changed for settle_seconds, and a child
+    # is processed once all of its files are ready. The manifest remembers what was done across restarts
+    print(f"Watching {directory} every {poll_seconds:g} s, press Ctrl+C to stop")
+    seen = {}  # file -> (size and mtime, when that stat was first seen)
+    done = {}  # file -> size and mtime when it was last handed to process_directory
+    warned = set()
     try:
-        all_man_timestamps = parsed_data["male_utterances"]
-        df_man = pd.DataFrame(all_man_timestamps, columns=["seg_id", "onset", "offset", "duration", "avg_dB", "peak_dB", "wordCount", "nonSpeechDur", "uttCnt", "uttLength", "its_file_name"])
-        df_man['offset'] = pd.to_numeric(df_man['offset']) 
-        df_man['seconds'] = ((df_man['offset'] // 60) * 60) + 60
-        df_man['child_id'] = child_id    
-    except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Male Utterances in file {its_file}: {e}")  
+        while True:
+            now = time.monotonic()
+            groups = {}
+            for f, its_file, child_id in list_its_files(directory, warned, kwargs.get("layout", "default")):
+                try:
+                    stat = input_stat(its_file)
+                except Exception:
+                    continue # removed or still being created
+                if f not in seen or seen[f][0] != stat:
+                    seen[f] = (stat, now)
+                groups.setdefault(child_id, []).append((f, its_file, child_id))
+
+            # children whose files are all settled and at least one of them is new or changed
+            ready = [entry for group in groups.values()
+                     if all(now - seen[f][1] >= settle_seconds for f, _, _ in group) and any(done.get(f) != seen[f][0] for f, _, _ in group)
+                     for entry in group]
+            if ready:
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')}: {len(ready)} file(s) ready")
+                process_directory(directory, output_base, its_files=ready, **kwargs)
+                # failed files are retried when they change or when the watcher restarts
+                done.update({f: seen[f][0] for f, _, _ in ready})
+            time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+#_______________________________________________________________________________
+
+def peak_rss_mb():
+    # high-water mark of the current process; ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+def run_summary(file_metrics, wall_seconds, jobs=1, slowest=10):
+    segments = sum(sum(m.get("segments", {}).values()) for m in file_metrics)
+    bytes_read = sum(m.get("bytes_read", 0) for m in file_metrics)
+    stage_seconds = {"parse": 0.0, "extract": 0.0, "dataframes": 0.0, "write": 0.0}
+    for m in file_metrics:
+        seconds = m.get("seconds", {})
+        stage_seconds["parse"] += seconds.get("parse", 0.0)
+        for stage in ("extract", "dataframes", "write"):
+            stage_seconds[stage] += sum(seconds.get(stage, {}).values())
+    # ru_maxrss is the high-water mark of a whole process, not of one file; the run peak is the highest of them
+    peaks = [m["process_peak_rss_mb"] for m in file_metrics if m.get("process_peak_rss_mb") is not None]
+    by_time = sorted(file_metrics, key=lambda m: m.get("seconds", {}).get("total", 0.0), reverse=True)
+    return {
+        "files": len(file_metrics),
+        "jobs": jobs,
+        "wall_seconds": round(wall_seconds, 3),
+        "segments": segments,
+        "segments_per_second": round(segments / wall_seconds, 1) if wall_seconds > 0 else None,
+        "bytes_read": bytes_read,
+        "mb_read_per_second": round(bytes_read / 1e6 / wall_seconds, 2) if wall_seconds > 0 else None,
+        "bytes_written": sum(m.get("bytes_written", 0) for m in file_metrics),
+        "stage_seconds": {stage: round(value, 3) for stage, value in stage_seconds.items()},
+        "peak_rss_mb": max(peaks) if peaks else None,
+        "slowest_files": [{"file": m.get("file"), "seconds": round(m.get("seconds", {}).get("total", 0.0), 3)} for m in by_time[:slowest]],
+    }
+
+def report_metrics(file_metrics, wall_seconds, jobs=1, profile=False, metrics_out=None):
+    summary = run_summary(file_metrics, wall_seconds, jobs)
+    if profile:
+        print(f"Processed {summary['files']} file(s), {summary['segments']} segments in {summary['wall_seconds']:.2f} s "
+              f"({summary['segments_per_second'] or 0:.0f} segments/s, {summary['mb_read_per_second'] or 0:.1f} MB/s read)")
+        print("Time per stage (summed over files): " + ", ".join(f"{stage} {value:.2f} s" for stage, value in summary["stage_seconds"].items()))
+        if summary["peak_rss_mb"] is not None:
+            print(f"Peak memory: {summary['peak_rss_mb']:.1f} MB")
+        for slow in summary["slowest_files"][:5]:
+            print(f"  {slow['seconds']:8.2f} s  {slow['file']}")
+    if metrics_out:
+        try:
+            with open(metrics_out, 'w') as fh:
+                json.dump({"summary": summary, "files": file_metrics}, fh, indent=1)
+        except Exception as e:
+            print(f"Error: An unexpected error occurred while writing the metrics report {metrics_out}: {e}")
+
+#_______________________________________________________________________________
+
+SCRIPT_VERSION = "2.1.0"
+SCHEMA_VERSION = 4 # bump whenever the columns or layout of the output files change
+MANIFEST_FILE = "lena_manifest.json"
+
+def output_paths(group, partitioned=False, options=None):
+    # files written for one group, relative to the output base directory
+    options = options or {}
+    output_format = options.get("output_format", "csv")
+    if output_format in STORE_FORMATS:
+        # the cohort store is shared by all groups, its rows are replaced per recording
+        return []
+    tables = output_tables(options.get("aggregate", False), options.get("speakers", SPEAKERS), options.get("conversations", True))
+    if partitioned:
+        return [dataset_file_path(DATASET_DIR, table, child_id, its_file, output_format) for _, its_file, child_id in group for table in tables]
+    child_id = group[0][2]
+    return [os.path.join(f"{child_id}_output", output_file_name(child_id, table, output_format)) for table in tables]
 
-    # Process Overlapping Near Utterances
+def file_hash(path, chunk_size=1 << 20):
+    archive, sep, member = path.partition(ARCHIVE_SEP)
+    if sep and not archive.endswith(".zip"):
+        # all members of a tar archive are hashed in a single pass
+        return tar_hashes(archive, os.stat(archive).st_mtime_ns, chunk_size)[member]
+    sha = hashlib.sha256()
+    with open_input(path) as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load_manifest(output_base, name=MANIFEST_FILE):
+    # an unreadable manifest or one written by another version means everything is rebuilt
+    empty = {"script_version": SCRIPT_VERSION, "schema_version": SCHEMA_VERSION, "files": {}}
     try:
-        all_oln_timestamps = parsed_data["overlapping_near_utterances"]
-        df_oln = pd.DataFrame(all_oln_timestamps, columns=["seg_id", "onset", "offset", "duration", "avg_dB", "peak_dB", "wordCount", "nonSpeechDur", "uttCnt", "uttLength", "its_file_name"])
-        df_oln['offset'] = pd.to_numeric(df_oln['offset']) 
-        df_oln['seconds'] = ((df_oln['offset'] // 60) * 60) + 60
-        df_oln['child_id'] = child_id    
-    except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Overlapping Near Utterances in file {its_file}: {e}")
+        with open(os.path.join(output_base, name)) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return empty
+    if manifest.get("script_version") != SCRIPT_VERSION or manifest.get("schema_version") != SCHEMA_VERSION:
+        return empty
+    return manifest
+
+def save_manifest(manifest, output_base, name=MANIFEST_FILE):
+    # write to a temporary file first so an interrupted run never leaves a truncated manifest
+    manifest_path = os.path.join(output_base, name)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def group_is_current(group, output_base, manifest, partitioned=False, options=None):
+    group_files = [f for f, _, _ in group]
+    for f, its_file, child_id in group:
+        entry = manifest["files"].get(f)
+        if entry is None or entry["group"] != group_files:
+            return False
+        if entry.get("options") != (options or {}) or entry.get("partitioned") != partitioned:
+            return False
+
+        # Input: size and mtime are enough when they match, otherwise fall back to the content hash
+        size, mtime_ns = input_stat(its_file)
+        if size != entry["size"]:
+            return False
+        if mtime_ns != entry["mtime_ns"]:
+            if file_hash(its_file) != entry["sha256"]:
+                return False
+            entry["mtime_ns"] = mtime_ns
+
+        # Outputs: every file must still be there, untouched since the last run
+        for name, (size, mtime_ns) in entry["outputs"].items():
+            try:
+                out_st = os.stat(os.path.join(output_base, name))
+            except OSError:
+                return False
+            if out_st.st_size != size or out_st.st_mtime_ns != mtime_ns:
+                return False
+    return True
+
+def update_manifest(manifest, groups, results, output_base, partitioned=False, options=None):
+    # a group is recorded only when all of its files processed without errors, so failures are retried next run
+    failed = {f for f, errors, _ in results if errors}
+    for child_id, group in groups.items():
+        group_files = [f for f, _, _ in group]
+        if failed.intersection(group_files):
+            for f in group_files:
+                manifest["files"].pop(f, None)
+            continue
+
+        outputs = {}
+        for name in output_paths(group, partitioned, options):
+            path = os.path.join(output_base, name)
+            if os.path.exists(path):
+                out_st = os.stat(path)
+                outputs[name] = [out_st.st_size, out_st.st_mtime_ns]
+
+        for f, its_file, _ in group:
+            size, mtime_ns = input_stat(its_file)
+            manifest["files"][f] = {
+                "path": its_file,
+                "size": size,
+                "mtime_ns": mtime_ns,
+                "sha256": file_hash(its_file),
+                "group": group_files,
+                "options": options or {},
+                "partitioned": partitioned,
+                "outputs": outputs,
+            }
+
+#_______________________________________________________________________________
 
-    # Process Overlapping Far Utterances
+SHARD_MARKER = re.compile(r"lena_shard_(\d+)_of_(\d+)\.done")
+
+def shard_manifest_name(index, count):
+    return f"lena_manifest.shard_{index}_of_{count}.json"
+
+def shard_marker_name(index, count):
+    return f"lena_shard_{index}_of_{count}.done"
+
+def shard_arg(text):
+    # argparse type for --shard INDEX/COUNT, with INDEX counted from 0
     try:
-        all_olf_timestamps = parsed_data["overlapping_far_utterances"]
-        df_olf = pd.DataFrame(all_olf_timestamps, columns=["seg_id", "onset", "offset", "duration", "avg_dB", "peak_dB", "wordCount", "nonSpeechDur", "uttCnt", "uttLength", "its_file_name"])
-        df_olf['offset'] = pd.to_numeric(df_olf['offset']) 
-        df_olf['seconds'] = ((df_olf['offset'] // 60) * 60) + 60
-        df_olf['child_id'] = child_id    
-    except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Overlapping Far Utterances in file {its_file}: {e}")
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, e.g. 0/16, got '{text}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}, got '{text}'")
+    return index, count
+
+def write_shard_marker(output_base, index, count, files, failed):
+    # written last, so its presence means the shard ran to the end; failed files are listed for merge
+    marker = {"shard": index, "count": count, "files": files, "failed": failed,
+              "script_version": SCRIPT_VERSION, "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    marker_path = os.path.join(output_base, shard_marker_name(index, count))
+    with open(marker_path + ".tmp", 'w') as fh:
+        json.dump(marker, fh, indent=1)
+    os.replace(marker_path + ".tmp", marker_path)
+
+def merge_shards(output_base, shard_dirs=None):
+    # combines the shard manifests into the cohort manifest of output_base, copying the outputs of shards
+    # written to other directories (e.g. node-local scratch); returns a list of problems, empty on success
+    shard_dirs = shard_dirs or [output_base]
+    markers = {}
+    for shard_dir in shard_dirs:
+        for name in sorted(os.listdir(shard_dir)):
+            match = SHARD_MARKER.fullmatch(name)
+            if match:
+                with open(os.path.join(shard_dir, name)) as fh:
+                    markers[(int(match.group(1)), int(match.group(2)))] = (shard_dir, json.load(fh))
+
+    if not markers:
+        return [f"Error: No shard completion markers found in {', '.join(shard_dirs)}"]
+    counts = sorted({count for _, count in markers})
+    if len(counts) > 1:
+        return [f"Error: Markers from runs with different shard counts ({', '.join(map(str, counts))}) found, remove the stale ones"]
+    missing = [str(index) for index in range(counts[0]) if (index, counts[0]) not in markers]
+    if missing:
+        return [f"Error: Shard(s) {', '.join(missing)} of {counts[0]} have not finished"]
+
+    problems = []
+    manifest = load_manifest(output_base)
+    copied = set()
+    for (index, count), (shard_dir, marker) in sorted(markers.items()):
+        if marker.get("script_version") != SCRIPT_VERSION:
+            problems.append(f"Error: Shard {index} was written by version {marker.get('script_version')}, not {SCRIPT_VERSION}")
+            continue
+        for f in marker["failed"]:
+            problems.append(f"Warning: File {f} failed in shard {index} and is not in the merged manifest")
+        for f, entry in load_manifest(shard_dir, shard_manifest_name(index, count))["files"].items():
+            if os.path.abspath(shard_dir) != os.path.abspath(output_base):
+                for name in entry["outputs"]:
+                    if name not in copied:
+                        os.makedirs(os.path.dirname(os.path.join(output_base, name)), exist_ok=True)
+                        # copy2 keeps the modification time recorded in the manifest
+                        shutil.copy2(os.path.join(shard_dir, name), os.path.join(output_base, name))
+                        copied.add(name)
+            manifest["files"][f] = entry
+    save_manifest(manifest, output_base)
+    print(f"Merged {len(markers)} shard(s), {len(manifest['files'])} file(s) in {os.path.join(output_base, MANIFEST_FILE)}")
+    return problems
+
+STORE_FORMATS = {"sqlite": ".sqlite", "duckdb": ".duckdb"}
+STORE_FILE = "lena_cohort"
+STORE_INDEXES = [("child_id", "onset"), ("its_file_name",), ("onset",)]
+# its_info and the *_bins tables have no onset, they are indexed on child_id alone
+STORE_INDEXES_WITHOUT_ONSET = [("child_id",), ("its_file_name",)]
+
+def store_path(output_base, output_format):
+    return os.path.join(output_base, STORE_FILE + STORE_FORMATS[output_format])
+
+def connect_store(path, output_format=None):
+    # the format follows the file extension when it is not given
+    if (output_format or ("duckdb" if path.endswith(".duckdb") else "sqlite")) == "duckdb":
+        import duckdb
+        return duckdb.connect(path)
+    con = sqlite3.connect(path, isolation_level=None) # transactions are opened explicitly
+    con.execute("PRAGMA journal_mode=WAL")
+    return con
+
+def sql_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return "INTEGER"
+    if dtype == np.float32:
+        return "REAL"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "TIMESTAMPTZ" if isinstance(dtype, pd.DatetimeTZDtype) else "TIMESTAMP"
+    return "TEXT"
 
-    # Process Conversation Turns
+def store_frame(df, its_file_name):
+    # same column types as the parquet output, plain strings instead of categoricals, and
+    # its_file_name on every table so the rows of a recording can be replaced
+    df = typed_columns(as_frame(df))
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    if 'its_file_name' not in df.columns:
+        df['its_file_name'] = its_file_name
+    return df
+
+def table_columns(con, table):
+    # None when the table does not exist yet
+    try:
+        return [column[0] for column in con.execute(f'SELECT * FROM "{table}" LIMIT 0').description]
+    except Exception:
+        return None
+
+def insert_recording(con, output_format, tables, its_file_name):
+    # replaces the rows of one recording in every table in a single transaction, so re-runs and
+    # appended recordings never leave duplicates; sqlite gets batched inserts, duckdb scans the DataFrame
+    con.execute("BEGIN TRANSACTION")
     try:
-        all_ct_timestamps = parsed_data["conversation_turns"]
-        df_ct = pd.DataFrame(all_ct_timestamps, columns=["seg_id", "onset", "offset", "duration", "avg_dB", "peak_dB", 
-                                                        "convo_count", "its_file_name", "ct_type", "femaleAdultInitiation", 
-                                                        "maleAdultInitiation", "childResponse", "childInitiation", 
-                                                        "femaleAdultResponse", "maleAdultResponse", "adultWordCnt", 
-                                                        "femaleAdultWordCnt", "maleAdultWordCnt", "femaleAdultUttCnt", 
-                                                        "maleAdultUttCnt", "femaleAdultUttLen", "maleAdultUttLen", 
-                                                        "femaleAdultNonSpeechLen", "maleAdultNonSpeechLen", "childUttCnt", 
-                                                        "childUttLen", "childCryVfxLen", "TVF", "FAN"])
-        df_ct['offset'] = pd.to_numeric(df_ct['offset']) 
-        df_ct['seconds'] = ((df_ct['offset'] // 60) * 60) + 60
-        df_ct['child_id'] = child_id
+        for table, df in tables:
+            df = store_frame(df, its_file_name)
+            columns = table_columns(con, table)
+            if columns is not None:
+                con.execute(f'DELETE FROM "{table}" WHERE its_file_name = ?', [its_file_name])
+            if df.empty:
+                continue
+
+            if columns is None:
+                con.execute(f'CREATE TABLE "{table}" (' + ", ".join(f'"{col}" {sql_type(df[col].dtype)}' for col in df.columns) + ")")
+            else:
+                # columns added by later options, e.g. more --fields
+                for col in df.columns:
+                    if col not in columns:
+                        con.execute(f'ALTER TABLE "{table}" ADD COLUMN "{col}" {sql_type(df[col].dtype)}')
+            # also run for existing tables, so stores created by earlier versions get new indexes
+            for index_columns in STORE_INDEXES if "onset" in df.columns else STORE_INDEXES_WITHOUT_ONSET:
+                if set(index_columns) <= set(df.columns):
+                    con.execute(f'CREATE INDEX IF NOT EXISTS "{table}_{"_".join(index_columns)}" ON "{table}" ('
+                                + ", ".join(f'"{col}"' for col in index_columns) + ")")
+
+            names = ", ".join(f'"{col}"' for col in df.columns)
+            if output_format == "duckdb":
+                con.register("recording", df)
+                con.execute(f'INSERT INTO "{table}" ({names}) SELECT {names} FROM recording')
+                con.unregister("recording")
+            else:
+                # tolist() gives Python scalars and NaN is stored as NULL; sqlite has no 32-bit floats, so
+                # float32 values go through their shortest repr (-24.33, not -24.329999923706055), and clock
+                # times are stored as ISO 8601 text
+                rows = zip(*(df[col].astype(str).astype(float).tolist() if df[col].dtype == np.float32
+                             else df[col].dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ").tolist() if pd.api.types.is_datetime64_any_dtype(df[col])
+                             else df[col].tolist() for col in df.columns))
+                con.executemany(f'INSERT INTO "{table}" ({names}) VALUES ({", ".join("?" * len(df.columns))})', rows)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+def parse_for_store(f, its_file, child_id, options, collect_metrics=False):
+    # worker side of the store formats: builds the tables, the loading process inserts them
+    errors = []
+    metrics = None
+    if collect_metrics:
+        metrics = {"file": its_file, "child_id": child_id, "bytes_read": input_stat(its_file)[0], "bytes_written": 0,
+                   "seconds": {"dataframes": {}, "write": {}}}
+    start = time.perf_counter()
+    tables = []
+    try:
+        tables = build_tables(its_file, child_id, errors, metrics=metrics, **options)
     except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Conversation Turns in file {its_file}: {e}")
+        errors.append(f"Error: An unexpected error occurred while processing file '{f}': {str(e)}")
+    if metrics is not None:
+        metrics["seconds"]["total"] = time.perf_counter() - start
+        metrics["process_peak_rss_mb"] = peak_rss_mb()
+    return f, its_file, errors, metrics, tables
 
-    # Process Child Information
+def parsed_files(files, jobs, options, collect_metrics=False):
+    # yields parsed files in order; at most 2 * jobs parsed files wait for the loader at any time
+    if jobs <= 1:
+        for f, its_file, child_id in files:
+            yield parse_for_store(f, its_file, child_id, options, collect_metrics)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for f, its_file, child_id in files:
+            pending.append(executor.submit(parse_for_store, f, its_file, child_id, options, collect_metrics))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def load_store(groups, output_base, jobs=1, options=None, collect_metrics=False):
+    # sqlite/duckdb output: files are parsed in worker processes and loaded into one cohort store by
+    # this process (a duckdb file only allows a single writer); returns [(f, errors, metrics)]
+    options = dict(options or {})
+    output_format = options.pop("output_format")
+    files = [entry for group in groups.values() for entry in group]
+    results = []
+    con = connect_store(store_path(output_base, output_format), output_format)
     try:
-        all_info = parsed_data["combined_info"]
-        df_info = pd.DataFrame([all_info], columns=["DOB", "gender", "age_mos", "startClockTime", "endClockTime", "startTimeSecs", "endTimeSecs"])
-        df_info['child_id'] = child_id
-        df_info['filename'] = its_file
+        for f, its_file, errors, metrics, tables in parsed_files(files, jobs, options, collect_metrics):
+            if not errors:
+                t0 = time.perf_counter()
+                try:
+                    insert_recording(con, output_format, tables, its_name(its_file))
+                except Exception as e:
+                    errors.append(f"Error: An unexpected error occurred while loading file '{f}' into the {output_format} store: {e}")
+                if metrics is not None:
+                    metrics["seconds"]["write"]["store"] = time.perf_counter() - t0
+            results.append((f, errors, metrics))
+    finally:
+        con.close()
+    if collect_metrics:
+        # the store is shared, so its size is counted once for the whole run
+        for _, _, metrics in results[-1:]:
+            metrics["bytes_written"] = os.path.getsize(store_path(output_base, output_format))
+    return results
+
+def query_store(path, sql, params=()):
+    # runs a query against a cohort store and returns a DataFrame
+    con = connect_store(path)
+    try:
+        if path.endswith(".duckdb"):
+            return con.execute(sql, list(params)).df()
+        return pd.read_sql_query(sql, con, params=list(params))
+    finally:
+        con.close()
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(prog="master_LENA_v2.py query", description="Query a cohort store written with --format sqlite or duckdb.")
+    parser.add_argument("store", help="Path of the store, e.g. output/lena_cohort.sqlite")
+    parser.add_argument("--table", default="CHN", help="Table to read: a speaker, CTC, its_info or <table>_bins (default: CHN)")
+    parser.add_argument("--child", help="Only rows of this child ID")
+    parser.add_argument("--recording", help="Only rows of this recording (its_file_name)")
+    parser.add_argument("--start", type=float, help="Only segments with onset at or after this many seconds into the recording")
+    parser.add_argument("--end", type=float, help="Only segments with onset before this many seconds into the recording")
+    parser.add_argument("--sql", help="Run this SQL statement instead of the filters above")
+    parser.add_argument("--limit", type=int, help="Return at most this many rows")
+    parser.add_argument("-o", "--output", help="Write the result to this CSV file instead of printing it")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.store):
+        parser.error(f"store {args.store} does not exist")
+    sql, params = args.sql, []
+    if sql is None:
+        filters = []
+        for column, value in (("child_id", args.child), ("its_file_name", args.recording)):
+            if value is not None:
+                filters.append(f'"{column}" = ?')
+                params.append(value)
+        if args.start is not None:
+            filters.append('"onset" >= ?')
+            params.append(args.start)
+        if args.end is not None:
+            filters.append('"onset" < ?')
+            params.append(args.end)
+        sql = f'SELECT * FROM "{args.table}"' + (" WHERE " + " AND ".join(filters) if filters else "")
+        if args.start is not None or args.end is not None:
+            sql += ' ORDER BY "child_id", "its_file_name", "onset"'
+    if args.limit is not None:
+        sql = f"SELECT * FROM ({sql}) AS result LIMIT {int(args.limit)}"
+
+    try:
+        result = query_store(args.store, sql, params)
     except Exception as e:
-        print(f"Error: An unexpected error occurred while processing Child Information in file {its_file}: {e}")   
+        print(f"Error: An unexpected error occurred while querying {args.store}: {e}")
+        return 1
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"Wrote {len(result)} row(s) to {args.output}")
+    else:
+        print(result.to_csv(index=False), end="")
+    return 0
 
-    # Write dataframes to CSV
-    list_to_csv(df_chn, f"{child_id}_CHN_timestamps.csv", output_dir)
-    list_to_csv(df_fan, f"{child_id}_FAN_timestamps.csv", output_dir)
-    list_to_csv(df_man, f"{child_id}_MAN_timestamps.csv", output_dir)
-    list_to_csv(df_oln, f"{child_id}_OLN_timestamps.csv", output_dir)
-    list_to_csv(df_olf, f"{child_id}_OLF_timestamps.csv", output_dir)
-    list_to_csv(df_ct, f"{child_id}_CTC_timestamps.csv", output_dir)
-    list_to_csv(df_info, f"{child_id}_its_info.csv", output_dir)
+SUMMARY_COLUMNS = ["files", "recordings", "hours", "chn_segments", "chn_utterances", "fan_words", "man_words", "adult_words",
+                   "conversations", "turns"]
 
-#_______________________________________________________________________________
+def column_total(column):
+    return float(np.frombuffer(column, dtype=NUMPY_TYPES[column.typecode]).sum(dtype=np.float64)) if len(column) else 0.0
 
-def process_directory(directory, output_base):
-    processed_files = set()
-    for f in sorted(os.listdir(directory)):
-        if f.endswith(".its") and f not in processed_files:
-            if f[-6] == '_':
-                print(f"Warning: Multiple files might be present for the same day. Skipping file {f}")
+def summarize_file(f, its_file, child_id):
+    # reduces one recording to a handful of totals; only the columns they need are extracted
+    try:
+        parsed_data = parse_its_file(its_file, ["CHN", "FAN", "MAN"], ["childUttCnt", "convo_count", "wordCount"])
+        recordings = parsed_data["recordings"]
+        turns = parsed_data["conversation_turns"]
+        fan_words = column_total(parsed_data["female_utterances"]["wordCount"])
+        man_words = column_total(parsed_data["male_utterances"]["wordCount"])
+        totals = [1, len(recordings),
+                  sum(float(end[:-1]) - float(start[:-1]) for _, _, start, end in recordings) / 3600,
+                  len(parsed_data["child_utterances"]["seg_id"]), column_total(parsed_data["child_utterances"]["childUttCnt"]),
+                  fan_words, man_words, fan_words + man_words,
+                  len(turns["seg_id"]), column_total(turns["convo_count"])]
+        # local recording day from the YYYYMMDD in the file name, the same per-day key as the duplicate-day
+        # rule; the clock times are UTC and can fall on the previous or next day. The UTC date of the first
+        # recording is only used when the name has no date
+        date = its_name(its_file)[8:16]
+        if len(date) == 8 and date.isdigit():
+            day = f"{date[:4]}-{date[4:6]}-{date[6:]}"
+        else:
+            day = recordings[0][0][:10] if recordings else ""
+        return f, child_id, day, totals, None
+    except Exception as e:
+        return f, child_id, None, None, f"Error: An unexpected error occurred while summarizing file '{f}': {str(e)}"
+
+def summarize_directory(directory, jobs=1, errors=None):
+    # cohort summary per child and day; each file is reduced to its totals as it is parsed and folded into
+    # running sums, so memory depends on the number of children and days, not on the number of segments
+    files = list_its_files(directory)
+    totals = {}
+    if jobs <= 1:
+        summaries = (summarize_file(*entry) for entry in files)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        summaries = executor.map(summarize_file, *zip(*files), chunksize=4) if files else []
+    try:
+        for f, child_id, day, file_totals, error in summaries:
+            if error:
+                report_error(error, errors)
                 continue
+            running = totals.setdefault((child_id, day), [0.0] * len(SUMMARY_COLUMNS))
+            for i, value in enumerate(file_totals):
+                running[i] += value
+    finally:
+        if jobs > 1:
+            executor.shutdown()
 
-            filename, _ = os.path.splitext(f)
-            its_file = os.path.join(directory, f)
-            child_id = filename[:7]
-            output_dir = os.path.join(output_base, f"{child_id}_output")
+    summary = pd.DataFrame([[child_id, day] + values for (child_id, day), values in sorted(totals.items())],
+                           columns=["child_id", "day"] + SUMMARY_COLUMNS)
+    for col in ("files", "recordings", "chn_segments", "chn_utterances", "conversations", "turns"):
+        summary[col] = summary[col].astype(np.int64)
+    # word counts have two decimals in the .its files; rounding drops the float32 noise of the sums
+    for col in ("fan_words", "man_words", "adult_words"):
+        summary[col] = summary[col].round(2)
+    summary["hours"] = summary["hours"].round(4)
+    return summary
+
+def summarize_main(argv):
+    parser = argparse.ArgumentParser(prog="master_LENA_v2.py summarize", description="Write a cohort summary per child and day: CHN segments and utterances, adult words, conversational turns and recording hours.")
+    parser.add_argument("-d", "--directory", required=True, help="Directory of .its files, as for a normal run")
+    parser.add_argument("-o", "--output", default="cohort_summary.csv", help="Summary file to write, .csv or .parquet (default: cohort_summary.csv)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        parser.error(f"directory {args.directory} does not exist")
+    errors = []
+    summary = summarize_directory(args.directory, args.jobs, errors)
+    for message in sorted(errors):
+        print(message)
+    if args.output.endswith(".parquet"):
+        write_columnar(summary, os.path.abspath(args.output), "parquet")
+    else:
+        list_to_csv(summary.set_index("child_id"), os.path.basename(args.output), os.path.dirname(os.path.abspath(args.output)))
+    print(f"Summarized {int(summary['files'].sum())} file(s) of {summary['child_id'].nunique()} child ID(s) into {args.output}")
+    return 1 if errors else 0
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(prog="master_LENA_v2.py merge", description="Combine the outputs and manifests of a sharded run into one cohort result.")
+    parser.add_argument("shard_dirs", nargs="*", help="Output directories of the shards (default: the merge output directory)")
+    parser.add_argument("-o", "--output", help="Cohort output directory", default=os.getcwd())
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    problems = merge_shards(args.output, args.shard_dirs)
+    for message in problems:
+        print(message)
+    return 1 if any(message.startswith("Error") for message in problems) else 0
 
-            try:
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-                process_one_file(its_file, child_id, output_dir)
-                processed_files.add(f)
-            except Exception as e:
-                print(f"Error: An unexpected error occurred while processing file '{f}': {str(e)}")
-                
 #_______________________________________________________________________________    
 
 if __name__ == "__main__":
+    # 'merge', 'query' and 'summarize' subcommands; everything else is the usual processing command line
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        sys.exit(merge_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        sys.exit(query_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "summarize":
+        sys.exit(summarize_main(sys.argv[2:]))
+
+
     parser = argparse.ArgumentParser(description="Process .its files based on the specified mode.")
-    parser.add_argument("-f", "--file", help="Path to a specific .its file to process")
-    parser.add_argument("-d", "--directory", help="Directory to process all .its files from")
+    parser.add_argument("-f", "--file", help="Path to a specific .its file to process (also .its.gz/.bz2/.xz, or archive.zip!/member.its)")
+    parser.add_argument("-d", "--directory", help="Directory to process all .its files from, including compressed files and zip/tar archives")
     parser.add_argument("-o", "--output", help="Output directory for storing the results", default=os.getcwd())
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS) + sorted(STORE_FORMATS), default="csv",
+                        help="Output file format (parquet and feather need pyarrow), or load everything into one sqlite/duckdb cohort store (duckdb needs the duckdb package)")
+    parser.add_argument("--partitioned", action="store_true", help="With parquet/feather, write one dataset partitioned by speaker and child_id instead of per-child files")
+    parser.add_argument("--bin-seconds", type=int, default=60, help="Width of the time bins used for the 'seconds' column and --aggregate")
+    parser.add_argument("--aggregate", action="store_true", help="Also write per-bin summaries (segment count, vocalization time, words, turns) for each speaker")
+    parser.add_argument("--speakers", default=",".join(SPEAKERS), help="Comma-separated speakers to extract (default: CHN,FAN,MAN,OLN,OLF)")
+    parser.add_argument("--fields", help="Comma-separated optional columns to extract, e.g. avg_dB,wordCount (default: all)")
+    parser.add_argument("--no-conversations", dest="conversations", action="store_false", help="Skip the conversation turns (CTC) table")
+    parser.add_argument("--no-clock-times", dest="clock_times", action="store_false", help="Leave out the recording_id, onset_clock and offset_clock columns")
+    parser.add_argument("--profile", action="store_true", help="Time each processing stage and print a summary at the end of the run")
+    parser.add_argument("--metrics-out", help="Write per-file stage timings and sizes, the peak memory of each process and a run summary to this JSON file")
+    parser.add_argument("--writers", type=int, default=0, help="Write output files from this many background threads per process, overlapping writes with parsing (default: 0, off)")
+    parser.add_argument("--write-queue", type=int, default=16, help="With --writers, the most tables kept in memory waiting to be written")
+    parser.add_argument("--shard", type=shard_arg, help="Process only shard INDEX/COUNT of the directory (INDEX from 0), balanced by file size; combine the shards with the 'merge' subcommand")
+    parser.add_argument("--watch", action="store_true", help="Keep running and process new .its files in the directory as they arrive")
+    parser.add_argument("--poll-seconds", type=float, default=10, help="With --watch, how often the directory is checked")
+    parser.add_argument("--settle-seconds", type=float, default=30, help="With --watch, how long a file's size must stay the same before it is processed")
+    parser.add_argument("--layout", choices=LAYOUTS, default="default",
+                        help="bolivia: child IDs and output of master_LENA_boliviaVoc_v2.py (one output directory per recording, its_info spanning all Recording blocks, no child_id columns)")
+    parser.add_argument("--engine", choices=ENGINES, default="pandas", help="Build tables as pandas DataFrames or as Arrow tables (arrow needs pyarrow and suits parquet/feather output)")
+    parser.add_argument("--force", action="store_true", help="Rebuild every file, ignoring the manifest of previous runs")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes used when processing a directory")
 
     args = parser.parse_args()
+    if args.partitioned and args.format == "csv":
+        parser.error("--partitioned needs --format parquet or feather")
+    if args.write_queue < 1:
+        parser.error("--write-queue must be at least 1")
+    if args.bin_seconds < 1:
+        parser.error("--bin-seconds must be at least 1")
+    if args.shard and args.file:
+        parser.error("--shard splits a directory and cannot be used with -f")
+    if args.watch and not args.directory:
+        parser.error("--watch needs -d")
+    if args.watch and args.shard:
+        # shards are balanced over the whole directory, not over the files that have settled so far
+        parser.error("--watch cannot be used with --shard")
+    if args.format in STORE_FORMATS and (args.partitioned or args.shard):
+        parser.error(f"--partitioned and --shard cannot be used with --format {args.format}")
+    if args.layout == "bolivia" and (args.partitioned or args.format in STORE_FORMATS):
+        # both key their rows on the child_id column that the bolivia layout leaves out
+        parser.error(f"--layout bolivia cannot be used with --partitioned or --format {args.format}")
+    try:
+        speakers, fields = check_options(args.speakers.split(",") if args.speakers else [],
+                                         args.fields.split(",") if args.fields else None)
+    except ValueError as e:
+        parser.error(str(e))
 
     if args.output:
         if not os.path.exists(args.output):
             os.makedirs(args.output)
 
     if args.file:
-        if os.path.exists(args.file):
+        if input_exists(args.file):
             directory, filename = os.path.split(args.file)
-            child_id = filename[:7]
+            child_id = file_child_id(its_name(filename), args.layout)
             output_dir = os.path.join(args.output, f"{child_id}_output")
-            if not os.path.exists(output_dir):
+            dataset_dir = os.path.join(args.output, DATASET_DIR) if args.partitioned else None
+            if dataset_dir is None and args.format not in STORE_FORMATS and not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-            process_one_file(args.file, child_id, output_dir)
+            metrics = {} if args.profile or args.metrics_out else None
+            run_start = time.perf_counter()
+            if args.format in STORE_FORMATS:
+                results = load_store({child_id: [(filename, args.file, child_id)]}, args.output, 1,
+                                     dict(output_format=args.format, bin_seconds=args.bin_seconds, aggregate=args.aggregate,
+                                          speakers=speakers, fields=fields, conversations=args.conversations, engine=args.engine,
+                                          clock_times=args.clock_times, layout=args.layout),
+                                     metrics is not None)
+                for _, errors, file_metrics in results:
+                    for message in errors:
+                        print(message)
+                    if metrics is not None:
+                        report_metrics([file_metrics], time.perf_counter() - run_start, 1, args.profile, args.metrics_out)
+            else:
+                process_one_file(args.file, child_id, output_dir, None, args.format, dataset_dir, args.bin_seconds, args.aggregate,
+                                 speakers, fields, args.conversations, metrics, engine=args.engine, clock_times=args.clock_times,
+                                 layout=args.layout)
+                if metrics is not None:
+                    report_metrics([metrics], time.perf_counter() - run_start, 1, args.profile, args.metrics_out)
         else:
             print("Specified file does not exist.")
     elif args.directory:
-        if os.path.isdir(args.directory):
-            process_directory(args.directory, args.output)
+        if os.path.isdir(args.directory) and args.watch:
+            # stop cleanly on SIGTERM too, e.g. when run as a service
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            watch_directory(args.directory, args.output, args.poll_seconds, args.settle_seconds, jobs=args.jobs, force=args.force,
+                            partitioned=args.partitioned, profile=args.profile, metrics_out=args.metrics_out, writers=args.writers,
+                            write_queue=args.write_queue, shard=args.shard, output_format=args.format, bin_seconds=args.bin_seconds,
+                            aggregate=args.aggregate, speakers=speakers, fields=fields, conversations=args.conversations, engine=args.engine,
+                            clock_times=args.clock_times, layout=args.layout)
+        elif os.path.isdir(args.directory):
+            process_directory(args.directory, args.output, args.jobs, args.force, args.partitioned,
+                              args.profile, args.metrics_out, args.writers, args.write_queue, args.shard, output_format=args.format, bin_seconds=args.bin_seconds, aggregate=args.aggregate,
+                              speakers=speakers, fields=fields, conversations=args.conversations, engine=args.engine,
+                              clock_times=args.clock_times, layout=args.layout)
         else:
             print("Specified directory does not exist.")
     else:
         # Process all files in the current directory of the script, use default output as current directory
-        process_directory(os.path.dirname(__file__), args.output)
\ No newline at end of file
+        process_directory(os.path.dirname(__file__), args.output, args.jobs, args.force, args.partitioned,
+                          args.profile, args.metrics_out, args.writers, args.write_queue, args.shard, output_format=args.format, bin_seconds=args.bin_seconds, aggregate=args.aggregate,
+                          speakers=speakers, fields=fields, conversations=args.conversations, engine=args.engine,
+                          clock_times=args.clock_times, layout=args.layout)
\ No newline at end of file
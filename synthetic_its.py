@@ -0,0 +1,150 @@
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+#_______________________________________________________________________________
+
+# Speakers of the segments inside conversations and pauses, with rough daylong proportions
+CONVERSATION_SPEAKERS = (["CHN"] * 5 + ["FAN"] * 5 + ["MAN"] * 2 + ["OLN"] * 2 + ["CXN"] + ["TVN"] + ["NON"]
+                         + ["OLF"] + ["CHF", "FAF", "MAF", "CXF", "TVF", "NOF"])
+PAUSE_SPEAKERS = ["SIL"] * 6 + ["OLF", "NOF", "TVF", "TVN", "NON", "CHF", "FAF", "MAF", "OLN", "CHN", "FAN", "MAN"]
+CONVERSATION_TYPES = ["CIC", "CIOCX", "CIOCAX", "AICF", "AICM", "AIOCF", "AIOCM", "AIOCCXF", "AIOCCXM", "AMF", "AMM", "XM", "XIOCC"]
+
+def its_duration(seconds, time_prefix=True):
+    # 'PT1.23S' for times, 'P1.23S' for durations
+    return f"{'PT' if time_prefix else 'P'}{seconds:.2f}S"
+
+def segment_attributes(rng, spkr, onset, offset):
+    # speaker-specific attributes as written by the LENA software
+    duration = offset - onset
+    attrs = {"spkr": spkr, "average_dB": f"{rng.uniform(-55, -20):.2f}", "peak_dB": f"{rng.uniform(-30, -5):.2f}"}
+    if spkr == "CHN":
+        utt = round(duration * rng.uniform(0.5, 0.9), 2)
+        cry = round(duration * rng.uniform(0, 0.2), 2) if rng.random() < 0.15 else 0.0
+        attrs.update({"childUttCnt": str(rng.randint(1, 3)), "childUttLen": its_duration(utt, False),
+                      "childCryVfxLen": its_duration(cry, False)})
+    elif spkr in ("FAN", "MAN"):
+        prefix = "femaleAdult" if spkr == "FAN" else "maleAdult"
+        utt = round(duration * rng.uniform(0.6, 0.95), 2)
+        attrs.update({f"{prefix}UttCnt": str(rng.randint(1, 2)), f"{prefix}UttLen": its_duration(utt, False),
+                      f"{prefix}WordCnt": f"{rng.uniform(0.5, 3.0) * duration:.2f}",
+                      f"{prefix}NonSpeechLen": its_duration(round(duration - utt, 2), False)})
+    attrs.update({"startTime": its_duration(onset), "endTime": its_duration(offset)})
+    return attrs
+
+def element(tag, attrs, close=True):
+    body = " ".join(f'{key}="{value}"' for key, value in attrs.items())
+    return f"<{tag} {body}{' /' if close else ''}>\n"
+
+def write_block(out, rng, tag, num, onset, speakers):
+    # one Conversation or Pause with its segments; returns (end time, number of segments)
+    segments = []
+    t = onset
+    for _ in range(rng.randint(2, 12)):
+        duration = round(rng.uniform(0.6, 4.0), 2)
+        spkr = rng.choice(speakers)
+        segments.append(segment_attributes(rng, spkr, t, t + duration))
+        t = round(t + duration, 2)
+
+    attrs = {"num": str(num)}
+    if tag == "Conversation":
+        # turn counts and totals are summed from the segments, like the LENA exports
+        chn = [s for s in segments if s["spkr"] == "CHN"]
+        fan = [s for s in segments if s["spkr"] == "FAN"]
+        man = [s for s in segments if s["spkr"] == "MAN"]
+        turns = sum(1 for a, b in zip(segments, segments[1:])
+                    if {a["spkr"], b["spkr"]} in ({"CHN", "FAN"}, {"CHN", "MAN"}))
+        fan_words = sum(float(s["femaleAdultWordCnt"]) for s in fan)
+        man_words = sum(float(s["maleAdultWordCnt"]) for s in man)
+        attrs.update({
+            "type": rng.choice(CONVERSATION_TYPES), "turnTaking": str(turns),
+            "femaleAdultInitiation": str(int(bool(fan) and segments[0]["spkr"] == "FAN")),
+            "maleAdultInitiation": str(int(bool(man) and segments[0]["spkr"] == "MAN")),
+            "childResponse": str(int(turns > 0 and segments[0]["spkr"] != "CHN")),
+            "childInitiation": str(int(segments[0]["spkr"] == "CHN")),
+            "femaleAdultResponse": str(int(bool(fan) and segments[0]["spkr"] == "CHN")),
+            "maleAdultResponse": str(int(bool(man) and segments[0]["spkr"] == "CHN")),
+            "adultWordCnt": f"{fan_words + man_words:.2f}",
+            "femaleAdultWordCnt": f"{fan_words:.2f}", "maleAdultWordCnt": f"{man_words:.2f}",
+            "femaleAdultUttCnt": str(len(fan)), "maleAdultUttCnt": str(len(man)),
+            "femaleAdultUttLen": its_duration(sum(float(s["femaleAdultUttLen"][1:-1]) for s in fan), False),
+            "maleAdultUttLen": its_duration(sum(float(s["maleAdultUttLen"][1:-1]) for s in man), False),
+            "femaleAdultNonSpeechLen": its_duration(sum(float(s["femaleAdultNonSpeechLen"][1:-1]) for s in fan), False),
+            "maleAdultNonSpeechLen": its_duration(sum(float(s["maleAdultNonSpeechLen"][1:-1]) for s in man), False),
+            "childUttCnt": str(sum(int(s["childUttCnt"]) for s in chn)),
+            "childUttLen": its_duration(sum(float(s["childUttLen"][1:-1]) for s in chn), False),
+            "childCryVfxLen": its_duration(sum(float(s["childCryVfxLen"][1:-1]) for s in chn), False),
+            "TVF": its_duration(sum(float(s["endTime"][2:-1]) - float(s["startTime"][2:-1]) for s in segments if s["spkr"] == "TVF"), False),
+            "FAN": its_duration(sum(float(s["endTime"][2:-1]) - float(s["startTime"][2:-1]) for s in fan), False),
+        })
+    attrs.update({"average_dB": f"{rng.uniform(-50, -25):.2f}", "peak_dB": f"{rng.uniform(-25, -5):.2f}",
+                  "startTime": its_duration(onset), "endTime": its_duration(t)})
+
+    out.write(element(tag, attrs, close=False))
+    for seg in segments:
+        out.write(element("Segment", seg))
+    out.write(f"</{tag}>\n")
+    return t, len(segments)
+
+def write_synthetic_its(path, hours=1.0, recordings=3, seed=0, start=datetime(2020, 1, 1, 7, 0, 0)):
+    # writes a realistic ITS file of the given length split into several Recording blocks;
+    # returns the number of Segment elements written
+    rng = random.Random(seed)
+    total = hours * 3600.0
+    segment_count = 0
+    with open(path, "w") as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write(f'<ITS fileName="{os.path.splitext(os.path.basename(path))[0]}" timeCreated="{start.isoformat()}Z">\n')
+        out.write("<ProcessingUnit>\n<UPL_Header>\n")
+        out.write(element("ChildInfo", {"algorithmAge": "P12M", "gender": rng.choice(["F", "M"]),
+                                        "dob": "2019-01-01", "chronologicalAge": f"P{rng.randint(6, 36):02d}M"}))
+        out.write("</UPL_Header>\n")
+
+        t = 0.0
+        clock = start
+        for num in range(1, recordings + 1):
+            end = total * num / recordings
+            rec_start = t
+            out.write(element("Recording", {"num": str(num), "startClockTime": clock.isoformat() + "Z",
+                                            "endClockTime": (clock + timedelta(seconds=end - rec_start)).isoformat() + "Z",
+                                            "startTime": its_duration(rec_start), "endTime": its_duration(end)}, close=False))
+            block = 0
+            while t < end - 60:
+                block += 1
+                if rng.random() < 0.4:
+                    t, n = write_block(out, rng, "Conversation", block, t, CONVERSATION_SPEAKERS)
+                else:
+                    t, n = write_block(out, rng, "Pause", block, t, PAUSE_SPEAKERS)
+                segment_count += n
+            t = end
+            out.write("</Recording>\n")
+            # the recorder is paused between Recording blocks
+            clock += timedelta(seconds=end - rec_start, hours=rng.uniform(0.25, 2))
+
+        out.write("</ProcessingUnit>\n</ITS>\n")
+    return segment_count
+
+#_______________________________________________________________________________
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic .its files for benchmarks and tests.")
+    parser.add_argument("-o", "--output", help="Output directory for the generated files", default=os.getcwd())
+    parser.add_argument("--hours", type=float, nargs="+", default=[1.0], help="Recording length of each file in hours")
+    parser.add_argument("-n", "--files", type=int, default=1, help="Number of files to write for each length")
+    parser.add_argument("--recordings", type=int, default=3, help="Number of Recording blocks per file")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    index = 0
+    for hours in args.hours:
+        for _ in range(args.files):
+            index += 1
+            # 7-character child ID followed by the recording date, as expected by master_LENA_v2.py
+            path = os.path.join(args.output, f"S{index:06d}_20200101.its")
+            n = write_synthetic_its(path, hours, args.recordings, args.seed + index)
+            print(f"Wrote {path}: {hours:g} hours, {n} segments")
@@ -0,0 +1,314 @@
+import bz2
+import gzip
+import json
+import lzma
+import os
+import shutil
+import tarfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from master_LENA_v2 import (BOLIVIA_INFO_COLUMNS, align_to_recordings, bin_durations, file_child_id, iter_its_directory,
+                            merge_shards, parse_its_file, process_directory, query_store, read_its_file, recording_timeline,
+                            shard_marker_name, store_path, summarize_directory)
+from synthetic_its import write_synthetic_its
+
+#_______________________________________________________________________________
+
+@pytest.fixture(scope="module")
+def cohort(tmp_path_factory):
+    # a small cohort with two recordings of the same child, so same-child ordering is covered too
+    directory = tmp_path_factory.mktemp("cohort")
+    names = ["S000001_20200101.its", "S000001_20200102.its", "S000002_20200101.its", "S000003_20200101.its"]
+    for seed, name in enumerate(names):
+        write_synthetic_its(os.path.join(directory, name), hours=0.25, seed=seed)
+    return str(directory)
+
+def output_files(output_base):
+    # contents of every output file, keyed by its path relative to the output directory; the manifest
+    # records input paths and times and is left out
+    files = {}
+    for root, _, names in os.walk(output_base):
+        for name in names:
+            if not name.endswith(".json"):
+                path = os.path.join(root, name)
+                with open(path, "rb") as fh:
+                    files[os.path.relpath(path, output_base)] = fh.read()
+    return files
+
+def run(cohort, output_base, **options):
+    process_directory(cohort, str(output_base), aggregate=True, **options)
+    return output_files(output_base)
+
+@pytest.fixture(scope="module")
+def serial(cohort, tmp_path_factory):
+    return run(cohort, tmp_path_factory.mktemp("serial"))
+
+#_______________________________________________________________________________
+
+@pytest.mark.parametrize("options", [{"jobs": 2}, {"writers": 2, "write_queue": 1}, {"jobs": 2, "writers": 2}],
+                         ids=["jobs", "writers", "jobs-writers"])
+def test_parallel_output_matches_serial(cohort, serial, tmp_path, options):
+    assert run(cohort, tmp_path, **options) == serial
+
+def test_arrow_engine_output_matches_pandas(cohort, serial, tmp_path):
+    pytest.importorskip("pyarrow")
+    assert run(cohort, tmp_path, engine="arrow") == serial
+
+def manifest_files(output_base):
+    # manifest entries without the modification times of the outputs, which differ from run to run
+    with open(os.path.join(output_base, "lena_manifest.json")) as fh:
+        files = json.load(fh)["files"]
+    for entry in files.values():
+        entry["outputs"] = {name: size for name, (size, _) in entry["outputs"].items()}
+    return files
+
+def run_shards(cohort, tmp_path, count):
+    shard_dirs = []
+    for index in range(count):
+        shard_dir = os.path.join(tmp_path, f"shard_{index}")
+        os.makedirs(shard_dir)
+        process_directory(cohort, shard_dir, aggregate=True, shard=(index, count))
+        shard_dirs.append(shard_dir)
+    return shard_dirs
+
+def test_merged_shards_match_unsharded_run(cohort, serial, tmp_path, capsys):
+    full = os.path.join(tmp_path, "full")
+    merged = os.path.join(tmp_path, "merged")
+    os.makedirs(merged)
+    run(cohort, full)
+    shard_dirs = run_shards(cohort, tmp_path, 2)
+    # the children are split between the shards, with both S000001 recordings in the same one
+    assert all(output_files(shard_dir) for shard_dir in shard_dirs)
+
+    assert merge_shards(merged, shard_dirs) == []
+    assert output_files(merged) == serial
+    assert manifest_files(merged) == manifest_files(full)
+
+    # the merged manifest matches the copied outputs, so a later run skips everything
+    capsys.readouterr()
+    process_directory(cohort, merged, aggregate=True)
+    assert "Skipping 4 unchanged file(s)" in capsys.readouterr().out
+
+def test_merge_reports_missing_shard(cohort, tmp_path):
+    shard_dirs = run_shards(cohort, tmp_path, 2)
+    os.remove(os.path.join(shard_dirs[1], shard_marker_name(1, 2)))
+    problems = merge_shards(shard_dirs[0], shard_dirs)
+    assert problems == ["Error: Shard(s) 1 of 2 have not finished"]
+    assert not os.path.exists(os.path.join(shard_dirs[0], "lena_manifest.json"))
+
+def test_rerun_skips_unchanged_files(cohort, tmp_path, capsys):
+    inputs = os.path.join(tmp_path, "inputs")
+    output_base = os.path.join(tmp_path, "out")
+    shutil.copytree(cohort, inputs)
+    process_directory(inputs, output_base)
+    capsys.readouterr()
+
+    process_directory(inputs, output_base)
+    assert "Skipping 4 unchanged file(s)" in capsys.readouterr().out
+
+    # a changed recording re-runs its whole child group, the other children are skipped
+    before = output_files(output_base)
+    write_synthetic_its(os.path.join(inputs, "S000001_20200102.its"), hours=0.1, seed=99)
+    process_directory(inputs, output_base)
+    assert "Skipping 2 unchanged file(s)" in capsys.readouterr().out
+    after = output_files(output_base)
+    changed = {name for name in after if after[name] != before[name]}
+    assert changed and all(name.startswith("S000001_output") for name in changed)
+
+    # a missing output is rebuilt even when the input did not change
+    os.remove(os.path.join(output_base, "S000002_output", "S000002_CTC_timestamps.csv"))
+    process_directory(inputs, output_base)
+    assert "Skipping 3 unchanged file(s)" in capsys.readouterr().out
+
+    process_directory(inputs, output_base, force=True)
+    assert "Skipping" not in capsys.readouterr().out
+
+def without_filename_column(files):
+    # its_info records the input path, which differs between plain, compressed and archived inputs
+    return {name: content if not name.endswith("_its_info.csv") else b"\n".join(line.rsplit(b",", 1)[0] for line in content.split(b"\n"))
+            for name, content in files.items()}
+
+@pytest.mark.parametrize("packing", ["gz", "bz2", "xz", "zip", "tar.gz"])
+def test_compressed_and_archived_inputs_match_plain_files(cohort, serial, tmp_path, capsys, packing):
+    inputs = os.path.join(tmp_path, "inputs")
+    os.makedirs(inputs)
+    names = sorted(os.listdir(cohort))
+    if packing == "zip":
+        with zipfile.ZipFile(os.path.join(inputs, "site.zip"), "w", zipfile.ZIP_DEFLATED) as zf:
+            for name in names:
+                zf.write(os.path.join(cohort, name), f"site/{name}")
+    elif packing == "tar.gz":
+        with tarfile.open(os.path.join(inputs, "site.tar.gz"), "w:gz") as tf:
+            # archive order differs from name order, so members are not always read front to back
+            for name in reversed(names):
+                tf.add(os.path.join(cohort, name), f"site/{name}")
+    else:
+        compress = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}[packing]
+        for name in names:
+            with open(os.path.join(cohort, name), "rb") as src, compress(os.path.join(inputs, f"{name}.{packing}"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+    files = run(inputs, os.path.join(tmp_path, "out"))
+    assert without_filename_column(files) == without_filename_column(serial)
+
+    # the manifest hashes compressed files and archive members too
+    capsys.readouterr()
+    process_directory(inputs, os.path.join(tmp_path, "out"), aggregate=True)
+    assert "Skipping 4 unchanged file(s)" in capsys.readouterr().out
+
+@pytest.mark.parametrize("output_format", ["sqlite", "duckdb"])
+def test_store_holds_every_recording_once(cohort, tmp_path, output_format):
+    if output_format == "duckdb":
+        pytest.importorskip("duckdb")
+    output_base = str(tmp_path)
+    path = store_path(output_base, output_format)
+    expected = {(table, os.path.basename(its_file)[:-4]): len(df)
+                for its_file, _, tables in iter_its_directory(cohort, aggregate=True) for table, df in tables.items()}
+
+    def stored_rows():
+        return {(table, its_file_name): rows for table in {table for table, _ in expected}
+                for its_file_name, rows in query_store(path, f'SELECT its_file_name, count(*) FROM "{table}" GROUP BY its_file_name').values}
+
+    # both recordings of S000001 are kept, and re-runs replace rows instead of adding them
+    process_directory(cohort, output_base, aggregate=True, output_format=output_format)
+    assert stored_rows() == {key: rows for key, rows in expected.items() if rows}
+    process_directory(cohort, output_base, aggregate=True, output_format=output_format, force=True)
+    assert stored_rows() == {key: rows for key, rows in expected.items() if rows}
+
+    if output_format == "sqlite":
+        for table, where in (("CHN", "child_id = 'S000002' AND onset > 100"), ("its_info", "child_id = 'S000002'"),
+                             ("CHN_bins", "child_id = 'S000002'")):
+            plan = query_store(path, f'EXPLAIN QUERY PLAN SELECT * FROM "{table}" WHERE {where}')
+            assert plan["detail"].str.contains(f"USING INDEX {table}_child_id").any()
+
+def test_serial_output_covers_every_table(serial):
+    tables = {name.split("_", 1)[1] for name in (os.path.basename(path) for path in serial)}
+    assert {"CHN_timestamps.csv", "CTC_timestamps.csv", "its_info.csv", "CHN_bins.csv", "CTC_bins.csv"} <= tables
+
+def test_chn_only_parse_matches_full_parse(cohort):
+    its_file = os.path.join(cohort, "S000002_20200101.its")
+    full = parse_its_file(its_file)
+    chn_only = parse_its_file(its_file, speakers=["CHN"], conversations=False)
+    assert set(chn_only["child_utterances"]) == set(full["child_utterances"])
+    for col, values in chn_only["child_utterances"].items():
+        assert list(values) == list(full["child_utterances"][col])
+    assert chn_only["recordings"] == full["recordings"]
+
+def test_bolivia_layout(cohort):
+    assert file_child_id("LB_01_123456", "bolivia") == "01_123456"
+    assert file_child_id("AB12345_20200101_2", "bolivia") == "AB12345_20200101_2"
+    its_file = os.path.join(cohort, "S000002_20200101.its")
+    tables = read_its_file(its_file, speakers=["CHN"], conversations=False, aggregate=True, bin_seconds=30, layout="bolivia")
+    assert sorted(tables) == ["CHN", "CHN_bins", "its_info"]
+    assert "child_id" not in tables["CHN"] and "child_id" not in tables["CHN_bins"]
+    info = tables["its_info"]
+    recordings = parse_its_file(its_file)["recordings"]
+    assert list(info.columns) == BOLIVIA_INFO_COLUMNS
+    assert (info["startClockTime"][0], info["endClockTime"][0]) == (recordings[0][0], recordings[-1][1])
+
+def test_summary_matches_table_totals(cohort):
+    summary = summarize_directory(cohort).set_index(["child_id", "day"])
+    # the two S000001 recordings are on different days according to their file names
+    assert list(summary.index) == [("S000001", "2020-01-01"), ("S000001", "2020-01-02"), ("S000002", "2020-01-01"), ("S000003", "2020-01-01")]
+    for its_file, child_id, tables in iter_its_directory(cohort):
+        day = os.path.basename(its_file)[8:16]
+        row = summary.loc[(child_id, f"{day[:4]}-{day[4:6]}-{day[6:]}")]
+        assert row["files"] == 1
+        assert row["chn_segments"] == len(tables["CHN"])
+        assert row["chn_utterances"] == tables["CHN"]["childUttCnt"].sum()
+        assert row["conversations"] == len(tables["CTC"])
+        assert row["turns"] == tables["CTC"]["convo_count"].sum()
+        assert row["fan_words"] == pytest.approx(tables["FAN"]["wordCount"].astype(float).sum(), abs=0.01)
+
+def test_clock_times_follow_recording_blocks(tmp_path):
+    its_file = os.path.join(tmp_path, "S000004_20200101.its")
+    write_synthetic_its(its_file, hours=0.5, recordings=3, seed=4)
+    recordings = parse_its_file(its_file)["recordings"]
+    starts = [float(start[:-1]) for _, _, start, _ in recordings]
+    clocks = [pd.Timestamp(clock) for clock, _, _, _ in recordings]
+    df = read_its_file(its_file, speakers=["CHN"], conversations=False)["CHN"]
+
+    assert sorted(df["recording_id"].unique()) == [1, 2, 3]
+    for row in df.itertuples():
+        block = max(i for i, start in enumerate(starts) if start <= row.onset)
+        assert row.recording_id == block + 1
+        assert abs(row.onset_clock - clocks[block] - pd.Timedelta(seconds=row.onset - starts[block])) < pd.Timedelta(microseconds=1)
+        assert abs(row.offset_clock - clocks[block] - pd.Timedelta(seconds=row.offset - starts[block])) < pd.Timedelta(microseconds=1)
+
+    # the recorder pause between two blocks shows up in the clock times but not in the onsets
+    last_of_first = df[df["recording_id"] == 1].iloc[-1]
+    first_of_second = df[df["recording_id"] == 2].iloc[0]
+    pause = (first_of_second["onset_clock"] - last_of_first["onset_clock"]).total_seconds()
+    assert pause - (first_of_second["onset"] - last_of_first["onset"]) >= 15 * 60
+
+def test_onset_before_first_block_goes_to_first_block():
+    timeline = recording_timeline([["2020-01-01T08:00:00Z", "", "600.00S", ""], ["2020-01-01T07:00:00Z", "", "100.00S", ""]])
+    recording_id, onset_clock, offset_clock = align_to_recordings(np.array([40.0, 100.0, 599.0, 600.0]), np.array([41.0, 101.0, 600.0, 601.0]), timeline)
+    # recording_id is the document order of the blocks, not their order in time
+    assert recording_id.tolist() == [2, 2, 2, 1]
+    expected = np.array(["2020-01-01T06:59:00", "2020-01-01T07:00:00", "2020-01-01T07:08:19", "2020-01-01T08:00:00"], dtype="datetime64[ns]")
+    assert (onset_clock == expected).all()
+    assert offset_clock[0] == np.datetime64("2020-01-01T06:59:01", "ns")
+
+def test_clock_times_without_recording_blocks():
+    recording_id, onset_clock, _ = align_to_recordings(np.array([1.0]), np.array([2.0]), recording_timeline([]))
+    assert recording_id.tolist() == [0] and np.isnat(onset_clock).all()
+
+@pytest.fixture
+def cohort_with_broken_file(tmp_path):
+    write_synthetic_its(os.path.join(tmp_path, "S000001_20200101.its"), hours=0.1, seed=1)
+    with open(os.path.join(tmp_path, "S000009_20200101.its"), "w") as fh:
+        fh.write("<ITS><broken")
+    return str(tmp_path)
+
+def test_read_its_file_raises_parse_errors(cohort_with_broken_file):
+    with pytest.raises(Exception):
+        read_its_file(os.path.join(cohort_with_broken_file, "S000009_20200101.its"))
+    with pytest.raises(Exception):
+        list(iter_its_directory(cohort_with_broken_file))
+
+def test_read_its_file_collects_errors(cohort_with_broken_file):
+    errors = []
+    assert read_its_file(os.path.join(cohort_with_broken_file, "S000009_20200101.its"), errors=errors) == {}
+    assert len(errors) == 1 and "S000009" in errors[0]
+
+@pytest.mark.parametrize("bin_seconds", [0, -5])
+def test_read_its_file_rejects_bins_narrower_than_a_second(cohort_with_broken_file, bin_seconds):
+    with pytest.raises(ValueError):
+        read_its_file(os.path.join(cohort_with_broken_file, "S000001_20200101.its"), bin_seconds=bin_seconds, aggregate=True)
+
+def test_iter_its_directory_skips_failing_files(cohort_with_broken_file):
+    errors = []
+    recordings = list(iter_its_directory(cohort_with_broken_file, errors=errors))
+    assert [child_id for _, child_id, _ in recordings] == ["S000001"]
+    assert {"CHN", "CTC", "its_info"} <= set(recordings[0][2])
+    assert len(errors) == 1 and "S000009" in errors[0]
+
+#_______________________________________________________________________________
+
+def brute_force_durations(onset, offset, bin_seconds, n_bins):
+    # overlap of every segment with every bin
+    totals = np.zeros(n_bins)
+    for a, b in zip(onset, offset):
+        for k in range(n_bins):
+            totals[k] += max(0.0, min(b, (k + 1) * bin_seconds) - max(a, k * bin_seconds))
+    return totals
+
+@pytest.mark.parametrize("bin_seconds", [1, 7, 60])
+def test_bin_durations_matches_brute_force(bin_seconds):
+    rng = np.random.default_rng(bin_seconds)
+    onset = np.round(rng.uniform(0, 600, 500), 2)
+    # from zero-length segments to segments spanning several bins
+    offset = onset + np.round(rng.exponential(5, 500), 2)
+    n_bins = int(offset.max() // bin_seconds) + 1
+    expected = brute_force_durations(onset, offset, bin_seconds, n_bins)
+    assert np.allclose(bin_durations(onset, offset, bin_seconds, n_bins), expected)
+
+def test_bin_durations_on_boundaries():
+    onset = np.array([0.0, 60.0, 59.0, 30.0])
+    offset = np.array([60.0, 60.0, 181.0, 30.0])
+    assert np.allclose(bin_durations(onset, offset, 60, 4), brute_force_durations(onset, offset, 60, 4))